@@ -0,0 +1,119 @@
+"""
+Check the vectorized descriptor against
+the reference per-atom implementation
+and compare their timings per structure;
+also check that the descriptor of n_atoms nearest atoms
+(as given to the models) is the prefix of the full one
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+from mpds_ml_labs.prediction import get_descriptor, periodic_elements, periodic_numbers
+from mpds_ml_labs.common import DATA_PATH
+from mpds_ml_labs.struct_utils import detect_format, poscar_to_ase, refine
+from mpds_ml_labs.cif_utils import cif_to_ase
+
+
+PREFIX_LENS = [100, 200, 264, 300, 400]
+
+def get_reference_descriptor(ase_obj, kappa=None, overreach=False):
+    """
+    The original per-atom descriptor
+    """
+    if not kappa: kappa = 18
+    if overreach: kappa *= 2
+
+    norms = np.array([ np.linalg.norm(vec) for vec in ase_obj.get_cell() ])
+    multiple = np.ceil(kappa / norms).astype(int)
+    ase_obj = ase_obj.repeat(multiple)
+    com = ase_obj.get_center_of_mass()
+    ase_obj.translate(-com)
+    del ase_obj[
+        [atom.index for atom in ase_obj if np.sqrt(np.dot(atom.position, atom.position)) > kappa]
+    ]
+
+    ase_obj.center()
+    ase_obj.set_pbc((False, False, False))
+    sorted_seq = np.argsort(np.fromiter((np.sqrt(np.dot(x, x)) for x in ase_obj.positions), float))
+    ase_obj = ase_obj[sorted_seq]
+
+    elements, positions = [], []
+    for atom in ase_obj:
+        elements.append(periodic_numbers[periodic_elements.index(atom.symbol)] - 1)
+        positions.append(int(round(np.sqrt(atom.position[0]**2 + atom.position[1]**2 + atom.position[2]**2) * 10)))
+
+    return np.array([elements, positions])
+
+
+if len(sys.argv) > 1 and os.path.isdir(sys.argv[1]):
+    target = sys.argv[1]
+else:
+    target = os.path.join(DATA_PATH, 'aflow-ml-cmp', 'test_structures')
+
+structures = sorted([os.path.join(target, f) for f in os.listdir(target) if os.path.isfile(os.path.join(target, f))])
+
+total_ref, total_vec, n_identical, n_prefixes, failed = 0, 0, 0, 0, []
+
+for fname in structures:
+    structure = open(fname).read()
+    fmt = detect_format(structure)
+
+    if fmt == 'cif':
+        ase_obj, error = cif_to_ase(structure)
+    elif fmt == 'poscar':
+        ase_obj, error = poscar_to_ase(structure)
+    else:
+        print('Error: %s is not a crystal structure' % fname)
+        continue
+
+    if error:
+        print(error)
+        continue
+    if 'disordered' in ase_obj.info:
+        continue
+
+    ase_obj, error = refine(ase_obj)
+    if error:
+        print(error)
+        continue
+
+    for overreach in [False, True]:
+        start_time = time.time()
+        reference = get_reference_descriptor(ase_obj, overreach=overreach)
+        ref_time = time.time() - start_time
+
+        start_time = time.time()
+        descriptor = get_descriptor(ase_obj, overreach=overreach)
+        vec_time = time.time() - start_time
+
+        total_ref += ref_time
+        total_vec += vec_time
+
+        identical = np.array_equal(reference, descriptor)
+        if identical:
+            n_identical += 1
+        else:
+            failed.append(fname)
+
+        for n_atoms in PREFIX_LENS:
+            if np.array_equal(get_descriptor(ase_obj, overreach=overreach, n_atoms=n_atoms), descriptor[:, :n_atoms]):
+                n_prefixes += 1
+            else:
+                identical = False
+                failed.append("%s (%s atoms)" % (fname, n_atoms))
+
+        print("{0:20} {1:9} atoms {2:6} reference {3:7.4f} sc vectorized {4:7.4f} sc {5}".format(
+            os.path.basename(fname),
+            'overreach' if overreach else 'plain',
+            len(reference[0]),
+            ref_time,
+            vec_time,
+            'OK' if identical else 'MISMATCH'
+        ))
+
+print("Reference done in %1.2f sc, vectorized done in %1.2f sc" % (total_ref, total_vec))
+print("Bit-identical descriptors: %s, prefixes: %s" % (n_identical, n_prefixes))
+assert not failed, "Descriptors differ for: %s" % ", ".join(failed)
@@ -0,0 +1,133 @@
+"""
+Benchmark the disorder modes of ase_to_prediction:
+the median over the random orderings (the reference)
+vs. the geometry template vs. the expected descriptor;
+also check that the averaged template descriptor
+varies less over the seeds with more realizations
+"""
+import os
+import sys
+import time
+import random
+from copy import deepcopy
+
+import numpy as np
+
+import mpds_ml_labs.prediction as prediction_module
+from mpds_ml_labs.prediction import ase_to_prediction, get_ordered_descriptor, load_ml_models, load_comp_models, prop_models
+from mpds_ml_labs.common import ML_MODELS, COMP_MODELS
+from mpds_ml_labs.struct_utils import detect_format, poscar_to_ase, json_to_ase
+from mpds_ml_labs.cif_utils import cif_to_ase
+
+
+N_RUNS = 5
+N_SEEDS = 10
+
+# occs_noneq, cell_abc, sg_n, basis_noneq, els_noneq
+DISORDERED_SAMPLES = {
+    'Mg0.5Ni0.3O': [[0.5, 0.3, 1], [4.2, 4.2, 4.2, 90, 90, 90], 225, [[0, 0, 0], [0, 0, 0], [0.5, 0.5, 0.5]], ['Mg', 'Ni', 'O']],
+    'Ce0.9Gd0.05O2': [[0.9, 0.05, 1], [5.41, 5.41, 5.41, 90, 90, 90], 225, [[0, 0, 0], [0, 0, 0], [0.25, 0.25, 0.25]], ['Ce', 'Gd', 'O']],
+    'SrTi0.98Nb0.02O3': [[1, 0.98, 0.02, 1], [3.905, 3.905, 3.905, 90, 90, 90], 221, [[0, 0, 0], [0.5, 0.5, 0.5], [0.5, 0.5, 0.5], [0.5, 0.5, 0]], ['Sr', 'Ti', 'Nb', 'O']],
+    'Zn0.999Al0.001O': [[0.999, 0.001, 1], [3.25, 3.25, 5.21, 90, 90, 120], 186, [[1/3, 2/3, 0], [1/3, 2/3, 0], [1/3, 2/3, 0.382]], ['Zn', 'Al', 'O']]
+}
+
+
+
+def get_seed_variance(ase_obj, n_iter):
+    """
+    Variance of the template descriptor over the seeds,
+    averaged over its entries, or None, if there is no template
+    """
+    prediction_module.N_ITER_TEMPLATE = n_iter
+
+    descriptors = []
+    for seed in range(N_SEEDS):
+        descriptor, error = get_ordered_descriptor(ase_obj, disorder='template', rng=random.Random(seed))
+        if error:
+            return None
+        descriptors.append(descriptor)
+
+    min_len = min(len(descriptor[0]) for descriptor in descriptors)
+    return np.var(np.stack([descriptor[:, :min_len] for descriptor in descriptors]), axis=0).mean()
+
+
+models, structures = [], {}
+
+for fname in [f for f in sys.argv[1:] if os.path.isfile(f)]:
+    if fname.endswith('.pkl'):
+        models.append(fname)
+        continue
+
+    structure = open(fname).read()
+    fmt = detect_format(structure)
+
+    if fmt == 'cif':
+        ase_obj, error = cif_to_ase(structure)
+    elif fmt == 'poscar':
+        ase_obj, error = poscar_to_ase(structure)
+    else:
+        print('Error: %s is not a crystal structure' % fname)
+        continue
+
+    if error:
+        print(error)
+    elif 'disordered' not in ase_obj.info:
+        print('Skipping ordered structure %s' % fname)
+    else:
+        structures[os.path.basename(fname)] = ase_obj
+
+if not structures:
+    for title, datarow in DISORDERED_SAMPLES.items():
+        ase_obj, error = json_to_ase(deepcopy(datarow))
+        assert not error, error
+        structures[title] = ase_obj
+
+active_ml_models = load_ml_models(models or ML_MODELS, debug=False)
+if COMP_MODELS:
+    active_ml_models = load_comp_models(COMP_MODELS, active_ml_models)
+
+for title, ase_obj in structures.items():
+    print(title + "="*40)
+
+    timings, outputs = {}, {}
+    for disorder in ['random', 'template', 'expected']:
+        runs = []
+        start_time = time.time()
+        for _ in range(N_RUNS):
+            prediction, error = ase_to_prediction(deepcopy(ase_obj), active_ml_models, disorder=disorder)
+            if error:
+                break
+            runs.append(prediction)
+        timings[disorder] = (time.time() - start_time) / N_RUNS
+
+        if error:
+            print("%s: %s" % (disorder, error))
+            continue
+
+        outputs[disorder] = {
+            prop_id: np.median([run[prop_id]['value'] for run in runs])
+            for prop_id in runs[0]
+        }
+
+    print(" ".join(["{0} {1:7.4f} sc".format(disorder, timings[disorder]) for disorder in outputs]))
+
+    if not outputs:
+        continue
+
+    for prop_id in sorted(list(outputs.values())[0]):
+        print("{0:40} {1}".format(
+            prop_models[prop_id]['name'],
+            " ".join(["%s %s" % (disorder, output[prop_id]) for disorder, output in outputs.items()])
+        ))
+
+    n_iter_template = prediction_module.N_ITER_TEMPLATE
+    variances = [get_seed_variance(ase_obj, n_iter) for n_iter in [1, n_iter_template // 6, n_iter_template]]
+    prediction_module.N_ITER_TEMPLATE = n_iter_template
+
+    if None in variances:
+        continue
+
+    print("Template variance over seeds with 1, %s, %s realizations: %s" % (
+        n_iter_template // 6, n_iter_template, " ".join("%.4f" % variance for variance in variances)
+    ))
+    assert variances[0] > variances[1] > variances[2] or not variances[0], "Variance does not drop with more realizations"
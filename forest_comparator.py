@@ -0,0 +1,97 @@
+"""
+Check the NumPy forests against
+the original sklearn models
+and compare their timings
+"""
+import os
+import sys
+import time
+from copy import deepcopy
+
+import numpy as np
+
+from mpds_ml_labs.prediction import load_ml_models, flatten_ml_models, get_aligned_descriptor, get_descriptor_len, get_batch_prediction, get_prediction
+from mpds_ml_labs.common import ML_MODELS, DATA_PATH
+from mpds_ml_labs.struct_utils import detect_format, poscar_to_ase, refine
+from mpds_ml_labs.cif_utils import cif_to_ase
+
+
+models = [f for f in sys.argv[1:] if f.endswith('.pkl') and os.path.isfile(f)]
+active_sk_models = load_ml_models(models or ML_MODELS, debug=False)
+assert active_sk_models, "No models to compare"
+
+active_np_models = flatten_ml_models(deepcopy(active_sk_models))
+
+target = os.path.join(DATA_PATH, 'aflow-ml-cmp', 'test_structures')
+structures = sorted([os.path.join(target, f) for f in os.listdir(target) if os.path.isfile(os.path.join(target, f))])
+
+descriptors = []
+for fname in structures:
+    structure = open(fname).read()
+    fmt = detect_format(structure)
+
+    if fmt == 'cif':
+        ase_obj, error = cif_to_ase(structure)
+    elif fmt == 'poscar':
+        ase_obj, error = poscar_to_ase(structure)
+    else:
+        print('Error: %s is not a crystal structure' % fname)
+        continue
+
+    if error:
+        print(error)
+        continue
+    if 'disordered' in ase_obj.info:
+        continue
+
+    ase_obj, error = refine(ase_obj)
+    if error:
+        print(error)
+        continue
+
+    descriptor, error = get_aligned_descriptor(ase_obj, n_atoms=get_descriptor_len(active_sk_models))
+    if error:
+        print(error)
+        continue
+
+    descriptors.append(descriptor.flatten())
+
+failed = []
+
+for prop_id in sorted(active_sk_models):
+    n_features = active_sk_models[prop_id].n_features_
+    d_input = np.array([descriptor[:n_features] for descriptor in descriptors if len(descriptor) >= n_features])
+
+    start_time = time.time()
+    sk_output = active_sk_models[prop_id].predict(d_input)
+    sk_time = time.time() - start_time
+
+    start_time = time.time()
+    np_output = active_np_models[prop_id].predict(d_input)
+    np_time = time.time() - start_time
+
+    diff = np.abs(np.asarray(sk_output, dtype=float) - np.asarray(np_output, dtype=float)).max()
+    if diff > 1E-09:
+        failed.append(prop_id)
+
+    print("Model %s on %s descriptors: sklearn %7.4f sc numpy %7.4f sc max diff %s" % (prop_id, len(d_input), sk_time, np_time, diff))
+
+for title, prediction_func in [
+    ('one by one', lambda models: [get_prediction(descriptor, models)[0] for descriptor in descriptors]),
+    ('batched', lambda models: get_batch_prediction(descriptors, models)[0])
+]:
+    start_time = time.time()
+    sk_predictions = prediction_func(active_sk_models)
+    sk_time = time.time() - start_time
+
+    start_time = time.time()
+    np_predictions = prediction_func(active_np_models)
+    np_time = time.time() - start_time
+
+    n_identical = len([1 for sk_prediction, np_prediction in zip(sk_predictions, np_predictions) if sk_prediction == np_prediction])
+
+    print("Predictions %s: sklearn %7.4f sc numpy %7.4f sc, identical %s of %s" % (
+        title, sk_time, np_time, n_identical, len(descriptors)
+    ))
+
+assert not failed, "Models differ: %s" % ", ".join(failed)
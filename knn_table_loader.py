@@ -0,0 +1,90 @@
+"""
+Convert the ml_knn table, dumped from Postgres, into the
+memory-mapped file for the in-process KNN engine (see knn_engine.py),
+set as knn_file in the settings
+
+Accepted inputs are either the plain pg_dump output (its COPY ml_knn block is used),
+or a CSV with the columns id, z, y, x, k, w, m, d, t, i, o, els, e.g. from
+\copy ml_knn TO 'ml_knn.csv' WITH CSV HEADER
+"""
+import os, sys
+import csv
+import time
+
+import numpy as np
+
+from mpds_ml_labs.knn_engine import KNN_PROP_IDS, encode_els, save_knn_table, load_knn_table
+
+
+LOAD_CHUNK = 500000 # rows
+
+
+def read_pg_dump(f, table='ml_knn'):
+    copy_header = None
+    for line in f:
+        if line.startswith('COPY ') and line.split()[1].split('.')[-1] == table:
+            copy_header = line
+            break
+    assert copy_header, "No COPY %s block found" % table
+
+    fields = [name.strip().strip('"') for name in copy_header[copy_header.index('(') + 1:copy_header.index(')')].split(',')]
+    for line in f:
+        if line.startswith('\\.'):
+            break
+        yield dict(zip(fields, line.rstrip('\n').split('\t')))
+
+
+def read_csv(f):
+    reader = csv.reader(f)
+    first = next(reader)
+    if 'els' in first:
+        fields = first
+    else:
+        fields = ['id'] + KNN_PROP_IDS + ['els']
+        yield dict(zip(fields, first))
+
+    for row in reader:
+        yield dict(zip(fields, row))
+
+
+args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+assert len(args) == 2, "Usage: knn_table_loader.py ml_knn.sql|ml_knn.csv target.knn [--no-index] [--no-kd-tree]"
+assert not os.path.exists(args[1])
+
+start_time = time.time()
+chunks, chunk, els, els_chunks, n_rows = {prop_id: [] for prop_id in KNN_PROP_IDS}, [], [], [], 0
+
+with open(args[0]) as f:
+    is_dump = not args[0].endswith('.csv')
+    for row in (read_pg_dump(f) if is_dump else read_csv(f)):
+        if row['els'] in ('\\N', ''):
+            continue
+        chunk.append([int(row[prop_id]) for prop_id in KNN_PROP_IDS])
+        els.append(row['els'])
+
+        if len(chunk) == LOAD_CHUNK:
+            chunk = np.array(chunk, dtype=np.int16)
+            for n, prop_id in enumerate(KNN_PROP_IDS):
+                chunks[prop_id].append(chunk[:, n])
+            els_chunks.append(encode_els(els))
+            n_rows += len(chunk)
+            chunk, els = [], []
+            print("Read %s rows" % n_rows)
+
+if chunk:
+    chunk = np.array(chunk, dtype=np.int16)
+    for n, prop_id in enumerate(KNN_PROP_IDS):
+        chunks[prop_id].append(chunk[:, n])
+    els_chunks.append(encode_els(els))
+    n_rows += len(chunk)
+
+assert n_rows, "No rows found"
+columns = {prop_id: np.concatenate(chunks[prop_id]) for prop_id in KNN_PROP_IDS}
+width = max(item.shape[1] for item in els_chunks)
+els = np.concatenate([np.pad(item, ((0, 0), (0, width - item.shape[1]))) for item in els_chunks])
+save_knn_table(args[1], columns, els, index='--no-index' not in sys.argv, kd_tree='--no-kd-tree' not in sys.argv)
+
+assert load_knn_table(args[1], verify=True).n_rows == n_rows
+print("Done with %s: %s rows, %.1f MB in %1.2f sc" % (
+    args[1], n_rows, os.path.getsize(args[1]) / 1024**2, time.time() - start_time
+))
@@ -0,0 +1,241 @@
+"""
+Build the ml_knn design table from the per-phase predictions
+by the radius-based neighbor learning: around each phase, the points
+of the properties space are sampled within the radius, and
+each point is labeled by the elements of the nearby phases, majority-voted.
+
+The input is a CSV with the header, having the columns *els*
+(the elements, e.g. Cl-Na) and z, y, x, k, w, m, d, t, i, o
+(in the units of prediction_ranges); the other columns are ignored.
+The output is either the file for the in-process KNN engine (*.knn, see knn_engine.py),
+or the Postgres table of the settings, filled by COPY (*db*).
+
+The chunks of phases are processed by a pool of processes and saved to the work folder,
+so an interrupted build is resumed; each chunk is seeded on its own,
+so the result does not depend on the scheduling. The work folder keeps a manifest
+of the input and the BUILD_* parameters, and its chunks are only resumed
+if they match, otherwise discarded; it is removed after a successful build
+"""
+import os, sys
+import io
+import csv
+import json
+import time
+import hashlib
+from multiprocessing import Pool
+
+import numpy as np
+from sklearn.neighbors import BallTree
+
+from mpds_ml_labs.prediction import periodic_elements, periodic_numbers
+from mpds_ml_labs.prediction_ranges import prediction_ranges
+from mpds_ml_labs.knn_engine import KNN_PROP_IDS, SMALLINT_MIN, SMALLINT_MAX, save_knn_table
+from mpds_ml_labs.common import KNN_TABLE, connect_database
+
+
+BUILD_CHUNK = 1000 # phases
+BUILD_SAMPLES = 87 # points per phase, i.e. about 10M rows for 115k phases
+BUILD_RADIUS = 0.05 # in the properties space normalized by prediction_ranges
+BUILD_SEED = 42
+MANIFEST_NAME = 'manifest.json'
+ELS_WIDTH = 19 # as els VARCHAR(19) of the table
+
+# NB. internally treated as *10 or *100 to fit SMALLINT, as in knn_sample
+SMALLINT_SCALES = np.array([{'x': 10, 'w': 10, 't': 10, 'i': 100}.get(prop_id, 1) for prop_id in KNN_PROP_IDS])
+LOWER = np.array([prediction_ranges[prop_id][0] for prop_id in KNN_PROP_IDS])
+WIDTH = np.array([prediction_ranges[prop_id][1] - prediction_ranges[prop_id][0] for prop_id in KNN_PROP_IDS])
+
+phases, labels, tree = None, None, None # per worker, see init_worker
+
+
+def read_predictions(file_name):
+    """
+    Returns:
+        Normalized properties (array)
+        Periodic numbers of the elements, zero-padded (int8 array)
+    """
+    values, decks = [], []
+    with open(file_name) as f:
+        for row in csv.DictReader(f):
+            values.append([float(row[prop_id]) for prop_id in KNN_PROP_IDS])
+            decks.append([periodic_numbers[periodic_elements.index(el)] for el in row['els'].split('-')])
+
+    width = max(len(deck) for deck in decks) + 1 # NB. as in ml_knn, at least one zero
+    els = np.zeros((len(decks), width), dtype=np.int8)
+    for n, deck in enumerate(decks):
+        els[n, :len(deck)] = deck
+
+    return (np.array(values) - LOWER) / WIDTH, els
+
+
+def init_worker(file_name):
+    global phases, labels, tree
+    phases, els = read_predictions(file_name)
+    labels = (els, np.unique(els, axis=0, return_inverse=True)[1].ravel())
+    tree = BallTree(phases)
+
+
+def build_chunk(args):
+    """
+    Sample the points around the phases of the chunk
+    and label them by the majority of the phases within the radius,
+    weighted by the inverse distance
+    """
+    n_chunk, work_dir = args
+    target = os.path.join(work_dir, 'chunk_%05d.npz' % n_chunk)
+    if os.path.exists(target):
+        return n_chunk, 0
+
+    rng = np.random.RandomState(BUILD_SEED + n_chunk)
+    centers = phases[n_chunk * BUILD_CHUNK:(n_chunk + 1) * BUILD_CHUNK]
+
+    directions = rng.standard_normal((len(centers), BUILD_SAMPLES, phases.shape[1]))
+    directions /= np.linalg.norm(directions, axis=2)[:, :, None]
+    radii = BUILD_RADIUS * rng.random_sample((len(centers), BUILD_SAMPLES, 1)) ** (1 / phases.shape[1])
+    points = (centers[:, None, :] + directions * radii).reshape(-1, phases.shape[1])
+
+    els, classes = labels
+    votes = []
+    neighbors, dists = tree.query_radius(points, BUILD_RADIUS, return_distance=True)
+    for point_neighbors, point_dists in zip(neighbors, dists):
+        weights = np.bincount(classes[point_neighbors], weights=1 / (point_dists + 1E-9))
+        votes.append(point_neighbors[classes[point_neighbors] == np.argmax(weights)][0])
+
+    columns = np.clip(np.rint((LOWER + points * WIDTH) * SMALLINT_SCALES), SMALLINT_MIN, SMALLINT_MAX).astype(np.int16)
+
+    tmp_name = target + '.tmp.npz'
+    np.savez(tmp_name, columns=columns, els=els[votes])
+    os.replace(tmp_name, target) # NB. atomic, so the chunks are either complete or absent
+    return n_chunk, len(columns)
+
+
+def get_manifest(file_name):
+    """
+    Everything the chunks depend on
+    """
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    return {
+        'input': digest.hexdigest(),
+        'chunk': BUILD_CHUNK,
+        'samples': BUILD_SAMPLES,
+        'radius': BUILD_RADIUS,
+        'seed': BUILD_SEED
+    }
+
+
+def get_chunk_names(work_dir):
+    return sorted(name for name in os.listdir(work_dir) if name.startswith('chunk_'))
+
+
+def prepare_work_dir(work_dir, manifest):
+    """
+    Discard the chunks of another input or parameters,
+    then write the manifest of the current build
+
+    Returns:
+        Number of the discarded chunks (int)
+    """
+    manifest_path = os.path.join(work_dir, MANIFEST_NAME)
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    stale = []
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f) != manifest:
+                stale = get_chunk_names(work_dir)
+    else:
+        stale = get_chunk_names(work_dir) # NB. of unknown origin
+
+    for name in stale:
+        os.remove(os.path.join(work_dir, name))
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+    return len(stale)
+
+
+def clean_work_dir(work_dir):
+    for name in get_chunk_names(work_dir) + [MANIFEST_NAME]:
+        os.remove(os.path.join(work_dir, name))
+    if not os.listdir(work_dir):
+        os.rmdir(work_dir)
+
+
+def format_els(deck):
+    """
+    Periodic numbers with a single trailing zero, as in the table,
+    e.g. 8,13,0; NB. the chunks are zero-padded to the widest deck
+    """
+    n_els = int(np.count_nonzero(deck))
+    return ','.join(map(str, deck[:n_els] + [0]))
+
+
+def copy_to_database(chunks):
+    """
+    Replace the contents of the table in a single transaction
+    """
+    for _, els in chunks:
+        too_long = [deck for deck in els.tolist() if len(format_els(deck)) > ELS_WIDTH]
+        if too_long:
+            raise RuntimeError("Elements %s do not fit the els column" % format_els(too_long[0]))
+
+    cursor, connection = connect_database()
+    cursor.execute("TRUNCATE %s" % KNN_TABLE)
+
+    for columns, els in chunks:
+        stream = io.StringIO()
+        writer = csv.writer(stream)
+        for values, deck in zip(columns.tolist(), els.tolist()):
+            writer.writerow(values + [format_els(deck)])
+        stream.seek(0)
+        cursor.execute("COPY %s (%s, els) FROM STDIN WITH CSV" % (KNN_TABLE, ', '.join(KNN_PROP_IDS)), stream=stream)
+
+    connection.commit()
+    connection.close()
+
+
+if __name__ == '__main__':
+
+    assert len(sys.argv) in [3, 4] and (sys.argv[2].endswith('.knn') or sys.argv[2] == 'db'), \
+        "Usage: ml_knn_builder.py predictions.csv target.knn|db [work_folder]"
+    assert sys.argv[2] == 'db' or not os.path.exists(sys.argv[2])
+
+    # NB. the chunks do not depend on the target, but on the input
+    work_dir = sys.argv[3] if len(sys.argv) == 4 else sys.argv[1] + '.chunks'
+
+    start_time = time.time()
+    n_stale = prepare_work_dir(work_dir, get_manifest(sys.argv[1]))
+    if n_stale:
+        print("Discarded %s chunks of another build in %s" % (n_stale, work_dir))
+
+    n_phases = len(read_predictions(sys.argv[1])[0])
+    n_chunks = (n_phases + BUILD_CHUNK - 1) // BUILD_CHUNK
+    print("Building %s chunks of %s phases in %s" % (n_chunks, n_phases, work_dir))
+
+    with Pool(initializer=init_worker, initargs=(sys.argv[1],)) as pool:
+        for n_chunk, n_rows in pool.imap_unordered(build_chunk, [(n, work_dir) for n in range(n_chunks)]):
+            print("Chunk %s: %s" % (n_chunk, "%s rows" % n_rows if n_rows else "done before"))
+
+    chunks = []
+    for n_chunk in range(n_chunks):
+        with np.load(os.path.join(work_dir, 'chunk_%05d.npz' % n_chunk)) as data:
+            chunks.append((data['columns'], data['els']))
+
+    if sys.argv[2] == 'db':
+        copy_to_database(chunks)
+    else:
+        save_knn_table(
+            sys.argv[2],
+            {prop_id: np.concatenate([columns[:, n] for columns, _ in chunks]) for n, prop_id in enumerate(KNN_PROP_IDS)},
+            np.concatenate([els for _, els in chunks])
+        )
+
+    clean_work_dir(work_dir)
+
+    print("Done with %s rows in %1.2f sc" % (sum(len(columns) for columns, _ in chunks), time.time() - start_time))
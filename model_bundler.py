@@ -0,0 +1,20 @@
+"""
+Export the models into a single bundle file,
+to be memory-mapped and shared by all the server workers
+"""
+import os, sys
+
+from mpds_ml_labs.prediction import load_ml_models, flatten_ml_models
+from mpds_ml_labs.numpy_forest import save_bundle, load_bundle
+
+
+assert len(sys.argv) > 2 and sys.argv[1].endswith('.bundle'), "Usage: model_bundler.py target.bundle model_one.pkl model_two.pkl ..."
+assert not os.path.exists(sys.argv[1])
+
+active_ml_models = flatten_ml_models(load_ml_models(sys.argv[2:]))
+
+print("Bundling models %s" % ", ".join(sorted(active_ml_models)))
+save_bundle(active_ml_models, sys.argv[1])
+
+assert sorted(load_bundle(sys.argv[1], verify=True)) == sorted(active_ml_models)
+print("Done with %s, %.1f MB" % (sys.argv[1], os.path.getsize(sys.argv[1]) / 1024**2))
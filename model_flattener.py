@@ -0,0 +1,19 @@
+import os, sys
+
+from mpds_ml_labs.prediction import load_ml_models, flatten_ml_models
+
+
+assert os.path.exists(sys.argv[1])
+
+active_ml_models = load_ml_models(sys.argv[1:])
+
+mod_path = './'
+mod_basename = '_flat.npz'
+
+for prop_id in active_ml_models:
+    assert not os.path.exists(mod_path + os.sep + prop_id + mod_basename)
+
+for prop_id, model in flatten_ml_models(active_ml_models).items():
+    print("Flattening model %s" % prop_id)
+    model.save(mod_path + os.sep + prop_id + mod_basename)
+    print("Done with %s" % prop_id)
@@ -0,0 +1,78 @@
+"""
+Quantize the models to the int16 thresholds
+and float32 node values (see quantize_forest),
+verify their predictions on the test structures
+and export them into a bundle (see model_bundler.py)
+"""
+import os
+import sys
+
+from mpds_ml_labs.prediction import load_ml_models, flatten_ml_models, get_aligned_descriptor, get_descriptor_len, get_batch_prediction
+from mpds_ml_labs.numpy_forest import quantize_forest, count_offgrid_thresholds, save_bundle, load_bundle
+from mpds_ml_labs.common import DATA_PATH
+from mpds_ml_labs.struct_utils import poscar_to_ase, refine
+
+
+def get_nbytes(model):
+    return sum(array.nbytes for array in model.get_arrays().values())
+
+
+assert len(sys.argv) > 2 and sys.argv[1].endswith('.bundle'), "Usage: model_quantizer.py target.bundle model_one.pkl model_two.pkl ..."
+assert not os.path.exists(sys.argv[1])
+
+active_ml_models = flatten_ml_models(load_ml_models(sys.argv[2:], debug=False))
+assert active_ml_models, "No models to quantize"
+
+target = os.path.join(DATA_PATH, 'aflow-ml-cmp', 'test_structures')
+descriptors = []
+for fname in sorted(os.listdir(target)):
+    ase_obj, error = poscar_to_ase(open(os.path.join(target, fname)).read())
+    if not error:
+        ase_obj, error = refine(ase_obj)
+    if not error:
+        descriptor, error = get_aligned_descriptor(ase_obj, n_atoms=get_descriptor_len(active_ml_models))
+    if error:
+        print("%s: %s" % (fname, error))
+        continue
+    descriptors.append(descriptor)
+
+reference, error = get_batch_prediction(descriptors, active_ml_models)
+assert not error, error
+
+quantized_models = dict(active_ml_models)
+total_before, total_after = 0, 0
+
+for prop_id in sorted(active_ml_models):
+    n_offgrid = count_offgrid_thresholds(active_ml_models[prop_id])
+
+    for compact_values in [True, False]:
+        quantized_models[prop_id] = quantize_forest(active_ml_models[prop_id], compact_values=compact_values)
+        predictions, error = get_batch_prediction(descriptors, quantized_models)
+        assert not error, error
+        if predictions == reference:
+            break
+    else:
+        raise RuntimeError("Model %s predictions are changed by quantization" % prop_id)
+
+    before, after = get_nbytes(active_ml_models[prop_id]), get_nbytes(quantized_models[prop_id])
+    total_before += before
+    total_after += after
+
+    print("Model %s: %.1f MB -> %.1f MB, node values %s, off-grid thresholds %s" % (
+        prop_id,
+        before / 1024**2,
+        after / 1024**2,
+        quantized_models[prop_id].value.dtype.name + ('' if compact_values else ' (float32 changes predictions)'),
+        n_offgrid
+    ))
+
+print("Predictions unchanged on %s structures; total %.1f MB -> %.1f MB (%.0f%% saved)" % (
+    len(descriptors),
+    total_before / 1024**2,
+    total_after / 1024**2,
+    100 * (1 - total_after / total_before)
+))
+
+save_bundle(quantized_models, sys.argv[1])
+assert sorted(load_bundle(sys.argv[1], verify=True)) == sorted(quantized_models)
+print("Done with %s" % sys.argv[1])
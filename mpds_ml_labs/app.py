@@ -1,17 +1,26 @@
 
 import os, sys
+import time
+import random
+import logging
+import threading
+from contextlib import closing
 
 import ujson as json
+import pg8000
 
 from flask import Flask, Blueprint, Response, request, send_from_directory
 
-from struct_utils import detect_format, poscar_to_ase, refine, get_formula, order_disordered
-from cif_utils import cif_to_ase, ase_to_eq_cif
-from prediction import prop_models, get_prediction, get_aligned_descriptor, get_ordered_descriptor, get_legend, load_ml_models, load_comp_models
-from common import SERVE_UI, ML_MODELS, COMP_MODELS, connect_database
-from knn_sample import knn_sample
-from similar_els import materialize, score_grade, score_abs
-from prediction_ranges import RANGE_TOLERANCE
+from mpds_ml_labs.struct_utils import detect_format, poscar_to_ase, refine, get_formula, order_disordered
+from mpds_ml_labs.cif_utils import cif_to_ase, ase_to_eq_cif
+from mpds_ml_labs.prediction import prop_models, get_prediction, get_batch_prediction, get_aligned_descriptor, get_ordered_descriptor, get_descriptor_len, get_legend, load_ml_models, load_comp_models
+from mpds_ml_labs.common import SERVE_UI, ML_MODELS, COMP_MODELS, CACHE_SIZE, CACHE_DIR, CACHE_FILES, MEMO_SIZE, DESIGN_BUDGET, BATCH_WINDOW, MAX_BATCH, KNN_FILE, DATA_PATH, pooled_database
+from mpds_ml_labs.knn_sample import knn_sample
+from mpds_ml_labs.knn_engine import load_knn_table
+from mpds_ml_labs.similar_els import MaterializeMemo, materialize_in_order, score_grade, score_abs, TIMEOUT_ERROR
+from mpds_ml_labs.prediction_ranges import RANGE_TOLERANCE, KNN_LEVELS
+from mpds_ml_labs.result_cache import ResultCache, get_fingerprint, get_text_fingerprint, get_models_version
+from mpds_ml_labs.coalescer import PredictionCoalescer
 
 
 __author__ = 'Evgeny Blokhin <eb@tilde.pro>'
@@ -22,6 +31,15 @@ __license__ = 'LGPL-2.1+'
 app_labs = Blueprint('app_labs', __name__)
 static_path = os.path.realpath(os.path.join(os.path.dirname(__file__), '../webassets'))
 active_ml_models = {}
+result_cache = ResultCache(CACHE_SIZE * 1024**2, CACHE_DIR, CACHE_FILES)
+coalescer = PredictionCoalescer(BATCH_WINDOW / 1000, MAX_BATCH) if BATCH_WINDOW else None
+materialize_memo = MaterializeMemo(MEMO_SIZE) if MEMO_SIZE else None # NB. otherwise per request
+is_ready = False # see warmup
+knn_table = load_knn_table(KNN_FILE) if KNN_FILE else None # NB. used instead of the database
+knn_stats, knn_stats_lock = {}, threading.Lock() # per matched level: queries and their total time
+design_stats = {'requests': 0, 'timeouts': 0, 'samples': 0} # and the total time per stage, see log_design_stages
+
+MAX_BATCH_SIZE = 100 # structures per request to /predict_batch
 
 
 def fmt_msg(msg, http_code=400):
@@ -51,6 +69,101 @@ def html_formula(string):
     return formula
 
 
+def parse_structure(structure):
+    """
+    Parse the provided CIF or POSCAR
+    and refine it, unless it is disordered
+
+    Returns:
+        ASE object *or* None
+        None *or* error (str)
+    """
+    if not 0 < len(structure) < 200000:
+        return None, 'Request size is invalid'
+
+    if not is_plain_text(structure):
+        return None, 'Request contains unsupported (non-latin) characters'
+
+    fmt = detect_format(structure)
+
+    if fmt == 'cif':
+        ase_obj, error = cif_to_ase(structure)
+        if error:
+            return None, error
+
+    elif fmt == 'poscar':
+        ase_obj, error = poscar_to_ase(structure)
+        if error:
+            return None, error
+
+    else: return None, 'Provided data format is not supported'
+
+    if 'disordered' in ase_obj.info:
+        return ase_obj, None
+
+    return refine(ase_obj)
+
+
+def get_structure_descriptor(ase_obj, rng=random):
+    """
+    Get the descriptor for the loaded models;
+    the disordered structures are resolved
+    reproducibly with a seeded rng
+
+    Returns:
+        descriptor (numpy array) *or* None
+        None *or* error (str)
+    """
+    if 'disordered' in ase_obj.info:
+        return get_ordered_descriptor(ase_obj, n_atoms=get_descriptor_len(active_ml_models), rng=rng)
+
+    return get_aligned_descriptor(ase_obj, n_atoms=get_descriptor_len(active_ml_models))
+
+
+def structure_to_descriptor(structure):
+    """
+    Parse the provided CIF or POSCAR
+    and get its descriptor for the loaded models
+
+    Returns:
+        ASE object *or* None
+        descriptor (numpy array) *or* None
+        None *or* error (str)
+    """
+    ase_obj, error = parse_structure(structure)
+    if error:
+        return None, None, error
+
+    descriptor, error = get_structure_descriptor(ase_obj)
+    if error:
+        return None, None, error
+
+    return ase_obj, descriptor, None
+
+
+def warmup():
+    """
+    Predict the sample structures from the data folder,
+    so that the models are paged in, before
+    the readiness is reported
+    """
+    global is_ready
+
+    samples = sorted(
+        os.path.join(DATA_PATH, f) for f in os.listdir(DATA_PATH)
+        if os.path.isfile(os.path.join(DATA_PATH, f)) and 'settings.ini' not in f
+    )
+    for fname in samples:
+        ase_obj, error = parse_structure(open(fname).read())
+        if not error:
+            descriptor, error = get_structure_descriptor(ase_obj)
+        if not error:
+            _, error = get_prediction(descriptor, active_ml_models)
+        print("Warmup with %s: %s" % (os.path.basename(fname), error or 'OK'))
+
+    is_ready = True
+
+
 if SERVE_UI:
     @app_labs.route('/', methods=['GET'])
     @app_labs.route('/props.html', methods=['GET'])
@@ -91,41 +204,32 @@ def predict():
         return fmt_msg('Invalid request')
 
     structure = request.values.get('structure')
-    if not 0 < len(structure) < 200000:
-        return fmt_msg('Request size is invalid')
-
-    if not is_plain_text(structure):
-        return fmt_msg('Request contains unsupported (non-latin) characters')
+    models_version = get_models_version(active_ml_models)
 
-    fmt = detect_format(structure)
+    # NB. the repeated inputs are resolved without parsing
+    text_key = get_text_fingerprint(structure) + models_version
+    answer = result_cache.get(text_key)
+    if answer is not None:
+        return Response(answer, content_type='application/json')
 
-    if fmt == 'cif':
-        ase_obj, error = cif_to_ase(structure)
-        if error:
-            return fmt_msg(error)
-
-    elif fmt == 'poscar':
-        ase_obj, error = poscar_to_ase(structure)
-        if error:
-            return fmt_msg(error)
+    ase_obj, error = parse_structure(structure)
+    if error:
+        return fmt_msg(error)
 
-    else: return fmt_msg('Provided data format is not supported')
+    key = get_fingerprint(ase_obj) + models_version
+    answer = result_cache.get(key)
+    if answer is not None:
+        result_cache.add_alias(text_key, key)
+        return Response(answer, content_type='application/json')
 
-    if 'disordered' in ase_obj.info:
-        descriptor, error = get_ordered_descriptor(ase_obj)
-        if error:
-            return fmt_msg(error)
+    descriptor, error = get_structure_descriptor(ase_obj, rng=random.Random(key))
+    if error:
+        return fmt_msg(error)
 
+    if coalescer:
+        prediction, error = coalescer.predict(descriptor, active_ml_models)
     else:
-        ase_obj, error = refine(ase_obj)
-        if error:
-            return fmt_msg(error)
-
-        descriptor, error = get_aligned_descriptor(ase_obj)
-        if error:
-            return fmt_msg(error)
-
-    prediction, error = get_prediction(descriptor, active_ml_models)
+        prediction, error = get_prediction(descriptor, active_ml_models)
     if error:
         return fmt_msg(error)
 
@@ -135,18 +239,120 @@ def predict():
         ase_obj.set_cell(orig_cell)
     ase_obj.center(about=0.0)
 
+    answer = json.dumps({
+        'prediction': prediction,
+        'legend': get_legend(prediction),
+        'formula': html_formula(get_formula(ase_obj)),
+        'p1_cif': ase_to_eq_cif(ase_obj)
+        }, indent=4, escape_forward_slashes=False
+    )
+    result_cache.put(key, answer, alias=text_key)
+
+    return Response(answer, content_type='application/json')
+
+
+@app_labs.route("/predict_batch", methods=['POST'])
+def predict_batch():
+    """
+    An endpoint for the properties
+    prediction of many structures at once,
+    provided as a JSON list of CIFs or POSCARs;
+    the results or errors are given per structure
+    in the order of the request
+    """
+    if 'structures' not in request.values:
+        return fmt_msg('Invalid request')
+
+    try: structures = json.loads(request.values.get('structures'))
+    except:
+        return fmt_msg('Invalid request')
+    if type(structures) != list or not all(type(structure) == str for structure in structures):
+        return fmt_msg('Invalid request')
+
+    if not 0 < len(structures) <= MAX_BATCH_SIZE:
+        return fmt_msg('Request size is invalid')
+
+    answers, descriptors, positions = [], [], []
+
+    for structure in structures:
+        ase_obj, descriptor, error = structure_to_descriptor(structure)
+        if error:
+            answers.append({'error': error})
+            continue
+
+        answers.append({'formula': get_formula(ase_obj)})
+        descriptors.append(descriptor)
+        positions.append(len(answers) - 1)
+
+    legend = {}
+    if descriptors:
+        predictions, error = get_batch_prediction(descriptors, active_ml_models)
+        if error:
+            return fmt_msg(error)
+
+        for n, prediction in zip(positions, predictions):
+            answers[n]['prediction'] = prediction
+            legend.update(get_legend(prediction))
+
     return Response(
         json.dumps({
-            'prediction': prediction,
-            'legend': get_legend(prediction),
-            'formula': html_formula(get_formula(ase_obj)),
-            'p1_cif': ase_to_eq_cif(ase_obj)
+            'results': answers,
+            'legend': legend
             }, indent=4, escape_forward_slashes=False
         ),
         content_type='application/json'
     )
 
 
+@app_labs.route("/ready", methods=['GET'])
+def ready():
+    """
+    A readiness probe, green only
+    after the warmup
+    """
+    if not is_ready:
+        return fmt_msg('Warming up', http_code=503)
+
+    return Response('{"ready":true}', content_type='application/json')
+
+
+@app_labs.route("/stats", methods=['GET'])
+def stats():
+    """
+    An utility endpoint to tune
+    the request coalescing and the caches,
+    and to follow the knn levels matched by /design
+    and where its time is spent
+    """
+    with knn_stats_lock:
+        knn_levels = {
+            level: {'queries': count, 'avg_ms': 1000 * total / count}
+            for level, (count, total) in knn_stats.items()
+        }
+        design = dict(design_stats)
+        for stage in ['knn', 'materialize', 'scoring', 'output']:
+            if stage in design:
+                design[stage] = {'avg_ms': 1000 * design.pop(stage) / design['requests']}
+    return Response(
+        json.dumps({
+            'coalescer': coalescer.get_stats() if coalescer else None,
+            'knn_levels': knn_levels,
+            'design': design,
+            'memo': {
+                'structures': len(materialize_memo.structures),
+                'hits': materialize_memo.n_hits,
+                'misses': materialize_memo.n_misses
+            } if materialize_memo else None,
+            'cache': {
+                'items': len(result_cache.items),
+                'size': result_cache.size,
+                'max_size': result_cache.max_size
+            }
+        }, indent=4),
+        content_type='application/json'
+    )
+
+
 @app_labs.route("/download_cif", methods=['POST'])
 def download_cif():
     """
@@ -202,31 +408,64 @@ def design():
 
     result, error = None, "No results (outside of prediction capabilities)"
 
-    cursor, connection = connect_database()
-    els_samples = knn_sample(cursor, user_ranges_dict)
-    connection.close()
-
-    results = []
+    start_time = time.time()
+    deadline = start_time + DESIGN_BUDGET if DESIGN_BUDGET else None
+    if knn_table:
+        els_samples, knn_level = knn_table.sample(user_ranges_dict)
+    else:
+        try:
+            with pooled_database() as (cursor, connection):
+                els_samples, knn_level = knn_sample(cursor, user_ranges_dict)
+        except RuntimeError as e:
+            return fmt_msg(str(e), http_code=503)
+        except (pg8000.Error, OSError) as e:
+            logging.error("Database failure: %s" % e)
+            return fmt_msg('Database unavailable', http_code=503)
+
+    stages = {'knn': time.time() - start_time, 'materialize': 0, 'scoring': 0, 'output': 0}
+
+    with knn_stats_lock:
+        level_stats = knn_stats.setdefault(str(knn_level) if knn_level in KNN_LEVELS + [None] else 'nearest', [0, 0])
+        level_stats[0] += 1
+        level_stats[1] += stages['knn']
+
+    results, best, n_samples, materialize_error = [], None, 0, None
     LIMIT_TOL = 1
-    while len(els_samples):
-        #print("TRYING TO MATERIALIZE", ", ".join(els_sample))
 
-        els_sample = els_samples.pop()
+    # NB. the samples are taken from the end, several at once, the outstanding ones are cancelled on break
+    stage_time = time.time()
+    with closing(materialize_in_order(
+        (els_sample for els_sample, _ in reversed(els_samples)),
+        active_ml_models, materialize_memo or MaterializeMemo(), deadline
+    )) as sequences:
+        for sequence, materialize_error in sequences:
+            if materialize_error:
+                error = materialize_error
+                break
+            n_samples += 1
+            if not sequence:
+                continue
 
-        sequence, error = materialize(els_sample, active_ml_models)
-        if error:
-            break
-        if not sequence:
-            continue
+            score_time = time.time()
+            result = score_grade(sequence, user_ranges_dict, range_tols)
+            stages['scoring'] += time.time() - score_time
+
+            if best is None or result['grade'] > best['grade']:
+                best = result
+
+            if result['grade'] > 6:
+                results.append(result)
+
+            if len(results) > LIMIT_TOL:
+                break
 
-        result = score_grade(sequence, user_ranges_dict, range_tols)
-        if result['grade'] > 6:
-            results.append(result)
+    stages['materialize'] = time.time() - stage_time - stages['scoring']
 
-        if len(results) > LIMIT_TOL:
-            break
+    if materialize_error == TIMEOUT_ERROR and best:
+        results = results or [best] # NB. the best result so far
 
     if results:
+        stage_time = time.time()
         result = score_abs(results, user_ranges_dict)
 
         answer_props = {prop_id: result['prediction'][prop_id]['value'] for prop_id in result['prediction']}
@@ -250,7 +489,7 @@ def design():
                 user_ranges_dict[k + '_max'],
                 prop_models[k]['gui_units']
             ])
-        return Response(
+        response = Response(
             json.dumps({
                 'vis_cif': ase_to_eq_cif(
                     result['structure'],
@@ -258,16 +497,41 @@ def design():
                     mpds_labs_loop=[ result['grade'] ] + aux_info
                 ),
                 'props': answer_props,
+                'knn_level': knn_level,
                 'formula': html_formula(formula),
                 'title': formula
                 }, indent=4, escape_forward_slashes=False
             ),
             content_type='application/json'
         )
+        stages['output'] = time.time() - stage_time
 
+        log_design_stages(stages, n_samples, materialize_error)
+        return response
+
+    log_design_stages(stages, n_samples, error)
     return fmt_msg(error)
 
 
+def log_design_stages(stages, n_samples, error=None):
+    """
+    Log the time spent by a /design request per stage,
+    summing them up for /stats
+    """
+    logging.info("Design in %1.2f sc: %s; %s samples materialized%s" % (
+        sum(stages.values()),
+        ", ".join("%s %1.2f sc" % (stage, stage_time) for stage, stage_time in stages.items()),
+        n_samples,
+        ", " + error if error else ""
+    ))
+    with knn_stats_lock:
+        design_stats['requests'] += 1
+        design_stats['timeouts'] += error == TIMEOUT_ERROR
+        design_stats['samples'] += n_samples
+        for stage, stage_time in stages.items():
+            design_stats[stage] = design_stats.get(stage, 0) + stage_time
+
+
 if __name__ == '__main__':
     if sys.argv[1:]:
         print("Models to load:\n" + "\n".join(sys.argv[1:]))
@@ -280,16 +544,21 @@ if __name__ == '__main__':
     else:
         print("No models to load")
 
+    if COMP_MODELS:
+        active_ml_models = load_comp_models(COMP_MODELS, active_ml_models)
+
+    warmup()
+
     app = Flask(__name__)
     app.debug = False
     app.register_blueprint(app_labs)
     app.run()
 
     # NB an external WSGI-compliant server is a must
-    # while exposing to the outer world
+    # while exposing to the outer world, see server.py
 
 else:
     active_ml_models = load_ml_models(ML_MODELS)
 
-if COMP_MODELS:
-    active_ml_models = load_comp_models(COMP_MODELS, active_ml_models)
+    if COMP_MODELS:
+        active_ml_models = load_comp_models(COMP_MODELS, active_ml_models)
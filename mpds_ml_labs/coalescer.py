@@ -0,0 +1,115 @@
+"""
+Micro-batching of the concurrent prediction requests:
+their descriptors are gathered over a short window
+and evaluated together, one model invocation per property
+"""
+import time
+import queue
+import threading
+
+from mpds_ml_labs.prediction import get_batch_prediction
+
+
+__author__ = 'Evgeny Blokhin <eb@tilde.pro>'
+__copyright__ = 'Copyright (c) 2020, Evgeny Blokhin, Tilde Materials Informatics'
+__license__ = 'LGPL-2.1+'
+
+
+class PredictionCoalescer(object):
+    """
+    A drop-in for get_prediction, to be called from the request threads;
+    a single background thread collects the queued descriptors
+    for up to *window* seconds after the first one, or until *max_batch*
+    of them, and runs get_batch_prediction on them.
+    Larger window means higher throughput but worse tail latency,
+    see get_stats to tune
+    """
+    def __init__(self, window=0.005, max_batch=64):
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+        self.n_batches, self.n_requests, self.largest_batch = 0, 0, 0
+        self.total_wait, self.max_wait = 0, 0
+
+    def predict(self, descriptor, ml_models, prop_ids=False):
+        """
+        Returns:
+            Prediction (dict) *or* None
+            None *or* error (str)
+        """
+        self.start()
+
+        slot = {'event': threading.Event(), 'queued': time.time(), 'result': (None, 'Prediction is not available')}
+        self.queue.put((descriptor, ml_models, prop_ids, slot))
+        slot['event'].wait()
+
+        return slot['result']
+
+    def start(self):
+        # NB. started lazily, i.e. after the server workers are forked
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='mpds_ml_coalescer', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            deadline = time.time() + self.window
+
+            while len(items) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            self.dispatch(items)
+
+    def dispatch(self, items):
+        started = time.time()
+
+        groups = {}
+        for item in items:
+            descriptor, ml_models, prop_ids, slot = item
+            key = (id(ml_models), prop_ids if type(prop_ids) != list else tuple(prop_ids))
+            groups.setdefault(key, []).append(item)
+
+        for group in groups.values():
+            _, ml_models, prop_ids, _ = group[0]
+            try:
+                predictions, error = get_batch_prediction([item[0] for item in group], ml_models, prop_ids)
+            except Exception as e:
+                predictions, error = None, str(e)
+
+            for n, (_, _, _, slot) in enumerate(group):
+                slot['result'] = (None, error) if error else (predictions[n], None)
+                slot['event'].set()
+
+        with self.lock:
+            self.n_batches += 1
+            self.n_requests += len(items)
+            self.largest_batch = max(self.largest_batch, len(items))
+            for item in items:
+                wait = started - item[3]['queued']
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'window_ms': self.window * 1000,
+                'max_batch': self.max_batch,
+                'queue_depth': self.queue.qsize(),
+                'batches': self.n_batches,
+                'requests': self.n_requests,
+                'avg_batch': self.n_requests / self.n_batches if self.n_batches else 0,
+                'largest_batch': self.largest_batch,
+                'avg_wait_ms': 1000 * self.total_wait / self.n_requests if self.n_requests else 0,
+                'max_wait_ms': 1000 * self.max_wait
+            }
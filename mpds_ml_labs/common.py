@@ -1,13 +1,32 @@
 
 import os
+import time
+import socket
+import threading
+from contextlib import contextmanager
 from configparser import ConfigParser
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urlsplit
 
 import ujson as json
 import pg8000
+import httplib2
 
 
 DATA_PATH = os.path.realpath(os.path.join(os.path.dirname(__file__), '../data'))
+DEFAULT_EVAL_THREADS = min(8, os.cpu_count() or 1) # global budget of the models evaluation threads
+DEFAULT_DESCRIPTOR_PROCESSES = min(4, os.cpu_count() or 1) # per server.py worker, for the descriptors of many structures (1 to disable)
+DEFAULT_CACHE_SIZE = 64 # MB of the cached results in memory
+DEFAULT_CACHE_FILES = 100000 # cached results on disk, see cache_dir, the least recently used are evicted (0 for unlimited)
+DEFAULT_DESIGN_THREADS = 4 # materializations at once, shared by the /design requests
+DEFAULT_DESIGN_BUDGET = 60 # sc per /design request, then the best result so far is given (0 for unlimited)
+DEFAULT_MEMO_SIZE = 10000 # items per table of the materialize memo shared by the /design requests (0 for per-request only)
+DEFAULT_SERVER_WORKERS = os.cpu_count() or 1 # forked by server.py, see also max_requests (0 for unlimited)
+DEFAULT_DB_POOL_SIZE = 4 # connections per process, see pooled_database
+DB_POOL_TIMEOUT = 10 # sc to wait for a free connection
+DB_HEALTH_INTERVAL = 30 # sc of idling, after which a pooled connection is checked
+DEFAULT_MAX_BATCH = 64 # descriptors coalesced from the concurrent requests, see BATCH_WINDOW (ms, 0 to disable)
+DEFAULT_HTTP_CONCURRENCY = 4 # requests in flight per upstream host and process, see pooled_http
+DEFAULT_HTTP_DEADLINE = 30 # sc per call to an upstream API, including the retries
 config = ConfigParser()
 config_path_a = './mpds_ml_labs.ini'
 config_path_b = os.path.join(DATA_PATH, 'settings.ini')
@@ -22,6 +41,21 @@ if current_config:
     API_KEY = config.get('mpds_ml_labs', 'api_key')
     API_ENDPOINT = config.get('mpds_ml_labs', 'api_endpoint')
     ELS_ENDPOINT = config.get('mpds_ml_labs', 'els_endpoint')
+    PROTOTYPES_FILE = config.get('mpds_ml_labs', 'prototypes', fallback=None) or None
+    EVAL_THREADS = config.getint('mpds_ml_labs', 'eval_threads', fallback=DEFAULT_EVAL_THREADS)
+    DESCRIPTOR_PROCESSES = config.getint('mpds_ml_labs', 'descriptor_processes', fallback=DEFAULT_DESCRIPTOR_PROCESSES)
+    CACHE_SIZE = config.getint('mpds_ml_labs', 'cache_size', fallback=DEFAULT_CACHE_SIZE)
+    CACHE_DIR = config.get('mpds_ml_labs', 'cache_dir', fallback=None) or None
+    CACHE_FILES = config.getint('mpds_ml_labs', 'cache_files', fallback=DEFAULT_CACHE_FILES)
+    MEMO_SIZE = config.getint('mpds_ml_labs', 'memo_size', fallback=DEFAULT_MEMO_SIZE)
+    DESIGN_THREADS = config.getint('mpds_ml_labs', 'design_threads', fallback=DEFAULT_DESIGN_THREADS)
+    DESIGN_BUDGET = config.getfloat('mpds_ml_labs', 'design_budget', fallback=DEFAULT_DESIGN_BUDGET)
+    BATCH_WINDOW = config.getfloat('mpds_ml_labs', 'batch_window', fallback=0)
+    MAX_BATCH = config.getint('mpds_ml_labs', 'max_batch', fallback=DEFAULT_MAX_BATCH)
+    SERVER_WORKERS = config.getint('mpds_ml_labs', 'workers', fallback=DEFAULT_SERVER_WORKERS)
+    SERVER_MAX_REQUESTS = config.getint('mpds_ml_labs', 'max_requests', fallback=0)
+    HTTP_CONCURRENCY = config.getint('mpds_ml_labs', 'http_concurrency', fallback=DEFAULT_HTTP_CONCURRENCY)
+    HTTP_DEADLINE = config.getfloat('mpds_ml_labs', 'http_deadline', fallback=DEFAULT_HTTP_DEADLINE)
 
     ML_MODELS, COMP_MODELS = [
         path.strip() for path in filter(None, ML_MODELS.split())
@@ -30,6 +64,8 @@ if current_config:
     ]
 
     KNN_TABLE = config.get('db', 'table')
+    KNN_FILE = config.get('db', 'knn_file', fallback=None) or None
+    DB_POOL_SIZE = config.getint('db', 'pool_size', fallback=DEFAULT_DB_POOL_SIZE)
 
 else:
     SERVE_UI = True
@@ -38,8 +74,25 @@ else:
     API_KEY = None
     API_ENDPOINT = None
     ELS_ENDPOINT = None
+    PROTOTYPES_FILE = None
+    EVAL_THREADS = DEFAULT_EVAL_THREADS
+    DESCRIPTOR_PROCESSES = DEFAULT_DESCRIPTOR_PROCESSES
+    CACHE_SIZE = DEFAULT_CACHE_SIZE
+    CACHE_DIR = None
+    CACHE_FILES = DEFAULT_CACHE_FILES
+    MEMO_SIZE = DEFAULT_MEMO_SIZE
+    DESIGN_THREADS = DEFAULT_DESIGN_THREADS
+    DESIGN_BUDGET = DEFAULT_DESIGN_BUDGET
+    BATCH_WINDOW = 0
+    MAX_BATCH = DEFAULT_MAX_BATCH
+    SERVER_WORKERS = DEFAULT_SERVER_WORKERS
+    SERVER_MAX_REQUESTS = 0
+    HTTP_CONCURRENCY = DEFAULT_HTTP_CONCURRENCY
+    HTTP_DEADLINE = DEFAULT_HTTP_DEADLINE
 
     KNN_TABLE = None
+    KNN_FILE = None
+    DB_POOL_SIZE = DEFAULT_DB_POOL_SIZE
 
 
 def connect_database():
@@ -58,6 +111,151 @@ def connect_database():
     return cursor, connection
 
 
+db_pool, db_pool_lock = [], threading.Lock() # idle connections with their last usage time
+db_pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+
+
+def reset_db_pool():
+    # NB. the connections of the parent are not to be used by the forked workers
+    global db_pool, db_pool_lock, db_pool_slots
+    db_pool, db_pool_lock = [], threading.Lock()
+    db_pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_db_pool)
+
+
+def is_connection_alive(connection):
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SELECT 1')
+        cursor.fetchall()
+    except (pg8000.Error, OSError):
+        return False
+    return True
+
+
+@contextmanager
+def pooled_database():
+    """
+    Borrow a connection from the pool of at most DB_POOL_SIZE ones,
+    opened on demand; the connections idling for long are checked,
+    the broken ones are dropped. Usage:
+
+    with pooled_database() as (cursor, connection):
+        ...
+    """
+    if not db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise RuntimeError('No database connections available')
+
+    try:
+        connection = None
+        while connection is None:
+            with db_pool_lock:
+                connection, last_used = db_pool.pop() if db_pool else (None, None)
+
+            if connection is None:
+                _, connection = connect_database()
+                connection.autocommit = True
+
+            elif time.time() - last_used > DB_HEALTH_INTERVAL and not is_connection_alive(connection):
+                try: connection.close()
+                except (pg8000.Error, OSError): pass
+                connection = None
+
+        broken = False
+        try:
+            yield connection.cursor(), connection
+
+        except (pg8000.Error, OSError):
+            broken = True
+            raise
+
+        finally:
+            if broken:
+                try: connection.close()
+                except (pg8000.Error, OSError): pass
+            else:
+                with db_pool_lock:
+                    db_pool.append((connection, time.time()))
+
+    finally:
+        db_pool_slots.release()
+
+
+def get_prepared_statement(connection, query):
+    """
+    Server-side prepared statement with the named parameters (:name),
+    kept for the lifetime of the (pooled) connection
+    """
+    if not hasattr(connection, 'prepared_statements'):
+        connection.prepared_statements = {}
+
+    if query not in connection.prepared_statements:
+        connection.prepared_statements[query] = connection.prepare(query)
+
+    return connection.prepared_statements[query]
+
+
+http_pools, http_pools_lock = {}, threading.Lock() # per upstream host: idle clients and the slots
+
+
+def reset_http_pools():
+    # NB. the keep-alive sockets of the parent are not to be shared by the forked workers
+    global http_pools, http_pools_lock
+    http_pools, http_pools_lock = {}, threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_http_pools)
+
+
+@contextmanager
+def pooled_http(address, timeout):
+    """
+    Borrow a keep-alive HTTP client for the host of the address,
+    at most HTTP_CONCURRENCY of them in use at once, since
+    a single httplib2.Http is not safe to share between the threads;
+    the timeout (sc) applies to both waiting for a client and the socket.
+    Usage:
+
+    with pooled_http(address, timeout) as network:
+        response, content = network.request(address, 'GET')
+    """
+    host = urlsplit(address).netloc
+    with http_pools_lock:
+        if host not in http_pools:
+            http_pools[host] = ([], threading.BoundedSemaphore(HTTP_CONCURRENCY))
+        pool, slots = http_pools[host]
+
+    if not slots.acquire(timeout=max(timeout, 0)):
+        raise socket.timeout('No HTTP clients available for %s' % host)
+
+    try:
+        with http_pools_lock:
+            network = pool.pop() if pool else httplib2.Http()
+
+        network.timeout = timeout
+        for connection in network.connections.values():
+            if connection.sock:
+                connection.sock.settimeout(timeout)
+
+        broken = False
+        try:
+            yield network
+
+        except (httplib2.HttpLib2Error, OSError):
+            broken = True
+            raise
+
+        finally:
+            if not broken:
+                with http_pools_lock:
+                    pool.append(network)
+
+    finally:
+        slots.release()
+
+
 def make_request(req, address, data={}, httpverb='POST', headers={}):
 
     address += '?' + urlencode(data)
@@ -0,0 +1,413 @@
+"""
+In-process replacement of the ml_knn Postgres table:
+the ten SMALLINT property columns are stored as int16 arrays,
+and the els as the fixed-width int8 rows of the periodic numbers,
+memory-mapped read-only (see mmap_arrays), and
+the same progressively widened box query as in knn_sample is answered
+either by the chunked vectorized masks or, if the table is indexed,
+by the per-column sorted permutations, the most selective column first.
+With the k-d tree over the property vectors, the rows nearest
+to the center of the requested box are found instead,
+first within the box, then anywhere
+"""
+import heapq
+import random
+from copy import deepcopy
+from decimal import Decimal, ROUND_HALF_UP
+
+import numpy as np
+
+from mpds_ml_labs.mmap_arrays import save_arrays, load_arrays
+from mpds_ml_labs.prediction import periodic_elements_lut
+from mpds_ml_labs.prediction_ranges import prediction_ranges, prediction_margins, KNN_LEVELS, KNN_MIN_ROWS
+
+
+__author__ = 'Evgeny Blokhin <eb@tilde.pro>'
+__copyright__ = 'Copyright (c) 2020, Evgeny Blokhin, Tilde Materials Informatics'
+__license__ = 'LGPL-2.1+'
+
+
+KNN_MAGIC = b'MPDSKNN2'
+KNN_PROP_IDS = ['z', 'y', 'x', 'k', 'w', 'm', 'd', 't', 'i', 'o']
+KNN_LIMIT = 3000 # rows, as in knn_sample
+KNN_CHUNK = 1 << 20 # rows per vectorized mask
+KNN_INDEX_RATIO = 0.05 # fraction of the rows selected by the best column, below which the index is used
+KD_LEAF_SIZE = 256 # rows
+
+# NB. the distance of score_abs, i.e. the sum of the differences
+# normalized by the prediction ranges, also *10 or *100 to fit SMALLINT
+KD_WEIGHTS = np.array([
+    1 / ((prediction_ranges[prop_id][1] - prediction_ranges[prop_id][0]) * {'x': 10, 'w': 10, 't': 10, 'i': 100}.get(prop_id, 1))
+    for prop_id in KNN_PROP_IDS
+])
+
+SMALLINT_MIN, SMALLINT_MAX = -32768, 32767
+ELS_LUT = periodic_elements_lut.tolist() # NB. indexed by periodic number
+
+
+def to_smallint(value, shift=0):
+    """
+    Postgres CAST(value AS NUMERIC)::SMALLINT, i.e.
+    the float at 15 significant digits, rounded half away from zero
+    """
+    value = Decimal('%.15g' % value) + Decimal(repr(shift))
+    value = int(value.quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    return min(max(value, SMALLINT_MIN), SMALLINT_MAX)
+
+
+def encode_els(els):
+    """
+    Args:
+        els: (list) els strings, as in the ml_knn table, e.g. '8,13,0'
+
+    Returns:
+        Periodic numbers (int8 array), zero-padded to the same width
+    """
+    decks = [[int(pn) for pn in deck.split(',')] for deck in els]
+    width = max([len(deck) for deck in decks] + [1])
+    result = np.zeros((len(decks), width), dtype=np.int8)
+    for n, deck in enumerate(decks):
+        result[n, :len(deck)] = deck
+    return result
+
+
+def decode_els(decks, ordered=False, rng=random):
+    """
+    Deduplicate the element sets (in any order of the elements)
+    and decode them with the lookup table;
+    the repeated sets are then materialized only once
+
+    Args:
+        decks: (int8 array) periodic numbers, see encode_els
+        ordered: (bool) whether to keep the order of the first occurrences,
+            otherwise the order is random, weighted by the multiplicities,
+            so that the samples popped from the end follow
+            the same distribution as the shuffled duplicates
+
+    Returns:
+        Els and their multiplicities (list of tuples)
+    """
+    if not len(decks):
+        return []
+
+    keys = np.ascontiguousarray(np.sort(decks, axis=1))
+    keys = keys.view(np.dtype((np.void, keys.shape[1]))).ravel() # NB. much faster than unique rows
+    _, first, counts = np.unique(keys, return_index=True, return_counts=True)
+
+    if ordered:
+        order = np.argsort(first)
+    else:
+        order = np.argsort([rng.random() ** (1 / count) for count in counts])
+
+    return [
+        ([ELS_LUT[pn] for pn in deck if pn], count)
+        for deck, count in zip(decks[first[order]].tolist(), counts[order].tolist())
+    ]
+
+
+def build_kd_tree(points, leaf_size=KD_LEAF_SIZE):
+    """
+    Implicit balanced k-d tree: the node n has the children 2n + 1 and 2n + 2,
+    the leaves are the last n_leaves nodes, each leaf owns
+    a contiguous range of the rows in the tree order;
+    the split is by the median of the dimension of the largest weighted spread
+
+    Returns:
+        Arrays (dict): the rows permutation, the tree-ordered points,
+            the leaves offsets and the nodes bounding boxes
+    """
+    n_rows = len(points)
+    n_leaves = 1
+    while n_leaves * leaf_size < n_rows:
+        n_leaves *= 2
+
+    perm = np.arange(n_rows, dtype=np.int32)
+    ranges = [(0, n_rows)]
+
+    while len(ranges) < n_leaves:
+        next_ranges = []
+        for start, end in ranges:
+            mid = start + (end - start) // 2
+            if end - start > 1:
+                subset = points[perm[start:end]]
+                axis = np.argmax((subset.max(axis=0) - subset.min(axis=0)) * KD_WEIGHTS)
+                order = np.argpartition(subset[:, axis], mid - start, kind='introselect')
+                perm[start:end] = perm[start:end][order]
+            next_ranges += [(start, mid), (mid, end)]
+        ranges = next_ranges
+
+    tree_points = points[perm]
+    offsets = np.array([start for start, _ in ranges] + [n_rows], dtype=np.int64)
+
+    n_nodes = 2 * n_leaves - 1
+    lower = np.full((n_nodes, points.shape[1]), SMALLINT_MAX, dtype=np.int16)
+    upper = np.full((n_nodes, points.shape[1]), SMALLINT_MIN, dtype=np.int16)
+    for n, (start, end) in enumerate(ranges):
+        if end > start:
+            lower[n_leaves - 1 + n] = tree_points[start:end].min(axis=0)
+            upper[n_leaves - 1 + n] = tree_points[start:end].max(axis=0)
+
+    for node in range(n_leaves - 2, -1, -1):
+        lower[node] = np.minimum(lower[2 * node + 1], lower[2 * node + 2])
+        upper[node] = np.maximum(upper[2 * node + 1], upper[2 * node + 2])
+
+    return {'kd_perm': perm, 'kd_points': tree_points, 'kd_offsets': offsets, 'kd_lower': lower, 'kd_upper': upper}
+
+
+def save_knn_table(file_name, columns, els, index=True, kd_tree=True):
+    """
+    Args:
+        columns: (dict) prop_id -> int16 array, all of the same length
+        els: (list) els strings, as in the ml_knn table, e.g. '8,13,0',
+            or their encoded array, see encode_els
+        index: (bool) whether to store the sorted permutations,
+            about three times the size of the columns
+        kd_tree: (bool) whether to store the k-d tree,
+            about twice the size of the columns
+    """
+    n_rows = len(els)
+    arrays = {}
+
+    for prop_id in KNN_PROP_IDS:
+        column = np.asarray(columns[prop_id])
+        assert len(column) == n_rows
+        assert column.min(initial=0) >= SMALLINT_MIN and column.max(initial=0) <= SMALLINT_MAX
+        arrays[prop_id] = column.astype(np.int16)
+
+    arrays['els'] = els if isinstance(els, np.ndarray) else encode_els(els)
+
+    if index:
+        for prop_id in KNN_PROP_IDS:
+            perm = np.argsort(arrays[prop_id], kind='stable').astype(np.int32)
+            arrays['perm_' + prop_id] = perm
+            arrays['sorted_' + prop_id] = arrays[prop_id][perm]
+
+    if kd_tree and n_rows:
+        arrays.update(build_kd_tree(np.stack([arrays[prop_id] for prop_id in KNN_PROP_IDS], axis=1)))
+
+    save_arrays(file_name, KNN_MAGIC, arrays, {'n_rows': n_rows, 'indexed': bool(index)})
+
+
+def load_knn_table(file_name, verify=False):
+    """
+    Returns:
+        KnnTable
+    """
+    arrays, header = load_arrays(file_name, KNN_MAGIC, verify=verify)
+    return KnnTable(arrays, header['n_rows'], header['indexed'])
+
+
+class KnnTable(object):
+    """
+    Read-only ml_knn table; the rows order is the order of loading,
+    and the first *limit* matching rows in this order are returned
+    """
+    def __init__(self, arrays, n_rows, indexed=False):
+        self.arrays = arrays
+        self.n_rows = n_rows
+        self.indexed = indexed
+        self.kd_tree = 'kd_perm' in arrays
+
+    def select(self, bounds, limit=KNN_LIMIT):
+        """
+        Args:
+            bounds: (dict) prop_id -> (min, max), inclusive, as int
+
+        Returns:
+            Row numbers (array)
+        """
+        if self.indexed:
+            spans = {}
+            for prop_id, (lower, upper) in bounds.items():
+                values = self.arrays['sorted_' + prop_id]
+                spans[prop_id] = ( # NB. the keys of the same dtype, not to upcast the column
+                    np.searchsorted(values, np.int16(lower), side='left'),
+                    np.searchsorted(values, np.int16(upper), side='right')
+                )
+            order = sorted(spans, key=lambda prop_id: spans[prop_id][1] - spans[prop_id][0])
+            start, end = spans[order[0]]
+
+            if end - start <= KNN_INDEX_RATIO * self.n_rows:
+                rows = self.arrays['perm_' + order[0]][start:end]
+                for prop_id in order[1:]:
+                    if not len(rows):
+                        break
+                    lower, upper = bounds[prop_id]
+                    values = self.arrays[prop_id][rows]
+                    rows = rows[(lower <= values) & (values <= upper)]
+                return np.sort(rows)[:limit]
+
+        found, n_found = [], 0
+        for start in range(0, self.n_rows, KNN_CHUNK):
+            end = min(start + KNN_CHUNK, self.n_rows)
+            mask = np.ones(end - start, dtype=bool)
+            for prop_id, (lower, upper) in bounds.items():
+                values = self.arrays[prop_id][start:end]
+                mask &= lower <= values
+                mask &= values <= upper
+
+            rows = np.flatnonzero(mask)[:limit - n_found] + start
+            found.append(rows)
+            n_found += len(rows)
+            if n_found >= limit:
+                break
+
+        return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+    def nearest(self, center, limit=KNN_LIMIT, bounds=None):
+        """
+        Best-first search of the k-d tree for the *limit* rows
+        nearest to the center, optionally only within the box
+
+        Args:
+            center: (dict) prop_id -> value
+            bounds: (dict) prop_id -> (min, max), inclusive, as int
+
+        Returns:
+            Row numbers (array), the nearest first
+            Distances (array)
+        """
+        center = np.array([center[prop_id] for prop_id in KNN_PROP_IDS], dtype=np.float64)
+        if bounds:
+            box_lower = np.array([bounds[prop_id][0] for prop_id in KNN_PROP_IDS])
+            box_upper = np.array([bounds[prop_id][1] for prop_id in KNN_PROP_IDS])
+
+        lower, upper, offsets = self.arrays['kd_lower'], self.arrays['kd_upper'], self.arrays['kd_offsets']
+        n_leaves = len(offsets) - 1
+
+        def get_bound(node):
+            if lower[node, 0] > upper[node, 0]:
+                return None # empty
+            if bounds and ((upper[node] < box_lower) | (lower[node] > box_upper)).any():
+                return None
+            return (np.maximum(lower[node] - center, 0) + np.maximum(center - upper[node], 0)) @ KD_WEIGHTS
+
+        found_rows, found_dists, n_found, worst = [], [], 0, np.inf
+        heap = [(get_bound(0), 0)] if get_bound(0) is not None else []
+
+        while heap:
+            bound, node = heapq.heappop(heap)
+            if bound > worst:
+                break
+
+            if node < n_leaves - 1:
+                for child in (2 * node + 1, 2 * node + 2):
+                    child_bound = get_bound(child)
+                    if child_bound is not None and child_bound <= worst:
+                        heapq.heappush(heap, (child_bound, child))
+                continue
+
+            start, end = offsets[node - n_leaves + 1:node - n_leaves + 3]
+            points = self.arrays['kd_points'][start:end]
+            dists = np.abs(points - center) @ KD_WEIGHTS
+            rows = self.arrays['kd_perm'][start:end]
+            if bounds:
+                mask = ((box_lower <= points) & (points <= box_upper)).all(axis=1)
+                dists, rows = dists[mask], rows[mask]
+
+            found_rows.append(rows)
+            found_dists.append(dists)
+            n_found += len(rows)
+
+            if n_found >= limit:
+                rows, dists = np.concatenate(found_rows), np.concatenate(found_dists)
+                if n_found > 2 * limit:
+                    keep = np.argpartition(dists, limit - 1)[:limit]
+                    rows, dists = rows[keep], dists[keep]
+                found_rows, found_dists, n_found = [rows], [dists], len(rows)
+                worst = np.partition(dists, limit - 1)[limit - 1]
+
+        if not found_rows:
+            return np.empty(0, dtype=np.int32), np.empty(0)
+
+        rows, dists = np.concatenate(found_rows), np.concatenate(found_dists)
+        order = np.lexsort((rows, dists))[:limit]
+        return rows[order], dists[order]
+
+    def query(self, prop_ranges_dict, limit=KNN_LIMIT):
+        """
+        The box progressively widened by KNN_LEVELS of prediction_margins, as in knn_sample;
+        with the k-d tree, the rows nearest to the box center, within the box,
+        if at least KNN_MIN_ROWS, otherwise anywhere (the nearest first)
+
+        Returns:
+            Els (int8 array), see encode_els
+            Level (float) *or* None, if nothing found; for the rows found
+                by the k-d tree outside the box, the narrowest of KNN_LEVELS
+                embracing all of them, as in knn_sample, otherwise
+                the fraction of prediction_margins needed to reach the farthest of them
+        """
+        def get_bounds(level):
+            return {
+                prop_id: (
+                    to_smallint(prop_ranges_dict[prop_id + '_min'], -prediction_margins[prop_id] * level),
+                    to_smallint(prop_ranges_dict[prop_id + '_max'], prediction_margins[prop_id] * level)
+                ) for prop_id in KNN_PROP_IDS
+            }
+
+        if self.kd_tree:
+            center = {
+                prop_id: (prop_ranges_dict[prop_id + '_min'] + prop_ranges_dict[prop_id + '_max']) / 2
+                for prop_id in KNN_PROP_IDS
+            }
+            bounds = get_bounds(0)
+            rows, _ = self.nearest(center, limit, bounds)
+            if len(rows) >= KNN_MIN_ROWS:
+                return self.arrays['els'][rows], 0
+
+            rows, _ = self.nearest(center, limit)
+            if not len(rows):
+                return self.arrays['els'][rows], None
+
+            values = {prop_id: self.arrays[prop_id][rows].astype(np.int64) for prop_id in KNN_PROP_IDS}
+
+            for level in KNN_LEVELS:
+                level_bounds = get_bounds(level)
+                if all(
+                    ((level_bounds[prop_id][0] <= values[prop_id]) & (values[prop_id] <= level_bounds[prop_id][1])).all()
+                    for prop_id in KNN_PROP_IDS
+                ):
+                    return self.arrays['els'][rows], level
+
+            return self.arrays['els'][rows], max(
+                int(np.maximum(np.maximum(bounds[prop_id][0] - values[prop_id], values[prop_id] - bounds[prop_id][1]), 0).max())
+                / prediction_margins[prop_id] for prop_id in KNN_PROP_IDS
+            )
+
+        found, found_level = np.empty(0, dtype=np.int64), None
+        for level in KNN_LEVELS:
+            rows = self.select(get_bounds(level), limit)
+            if len(rows):
+                found, found_level = rows, level
+            if len(rows) >= KNN_MIN_ROWS:
+                break
+
+        return self.arrays['els'][found], found_level
+
+    def sample(self, user_ranges_dict):
+        """
+        A drop-in for knn_sample; NB. the nearest rows
+        found outside the box are not shuffled, but put
+        the nearest last, as they are popped from the end
+
+        Returns:
+            Els and their multiplicities (list of tuples)
+            Level (float) *or* None, see query
+        """
+        prop_ranges_dict = deepcopy(user_ranges_dict)
+
+        for prop_id in ['x', 'w', 't']:
+            # NB. internally treated as *10 to fit SMALLINT
+            prop_ranges_dict[prop_id + '_min'] *= 10
+            prop_ranges_dict[prop_id + '_max'] *= 10
+
+        # NB. internally treated as *100 to fit SMALLINT
+        prop_ranges_dict['i_min'] *= 100
+        prop_ranges_dict['i_max'] *= 100
+
+        decks, level = self.query(prop_ranges_dict)
+
+        if not self.kd_tree or not level:
+            return decode_els(decks), level
+
+        return decode_els(decks, ordered=True)[::-1], level
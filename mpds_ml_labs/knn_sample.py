@@ -2,12 +2,55 @@
 import random
 from copy import deepcopy
 
-from common import KNN_TABLE
-from prediction import periodic_elements, periodic_numbers
-from prediction_ranges import prediction_margins
+from mpds_ml_labs.common import KNN_TABLE, get_prepared_statement
+from mpds_ml_labs.prediction import periodic_elements, periodic_numbers
+from mpds_ml_labs.knn_engine import encode_els, decode_els
+from mpds_ml_labs.prediction_ranges import prediction_margins, KNN_LEVELS, KNN_MIN_ROWS
+
+
+PROP_IDS = ['z', 'y', 'x', 'k', 'w', 'm', 'd', 't', 'i', 'o']
+
+# NB. prepared once per connection, with the bound ranges;
+# a level is only queried, if all the narrower ones have not enough rows;
+# the rows of a level are taken in the order of the indexed id,
+# starting from a random one and wrapping around, so that
+# LIMIT does not always favor the same (i.e. the first built) phases
+KNN_QUERY = "WITH start AS (\nSELECT (CAST(:start AS NUMERIC) * MAX(id))::INT AS id FROM {table}\n),\n".format(table=KNN_TABLE) + ",\n".join("""level{n} AS (
+(SELECT {n} AS level, els FROM {table} WHERE {skip}
+    id >= (SELECT id FROM start) AND
+    {bounds}
+    ORDER BY id LIMIT 3000)
+UNION ALL
+(SELECT {n} AS level, els FROM {table} WHERE {skip}
+    id < (SELECT id FROM start) AND
+    {bounds}
+    ORDER BY id LIMIT 3000)
+LIMIT 3000
+)""".format(
+    n=n,
+    table=KNN_TABLE,
+    skip="".join("(SELECT COUNT(*) FROM level%s) < :min_rows AND " % m for m in range(n)),
+    bounds=" AND\n    ".join(
+        "(CAST(:{0}_min AS NUMERIC) - {1})::SMALLINT <= {0} AND {0} <= (CAST(:{0}_max AS NUMERIC) + {1})::SMALLINT".format(
+            prop_id, prediction_margins[prop_id] * level
+        ) for prop_id in PROP_IDS
+    )
+) for n, level in enumerate(KNN_LEVELS)) + "\n" + "\nUNION ALL\n".join(
+    "SELECT level, els FROM level%s" % n for n in range(len(KNN_LEVELS))
+)
 
 
 def knn_sample(db_handle, user_ranges_dict):
+    """
+    Progressively widen the ranges by KNN_LEVELS of prediction_margins
+    in a single query, taking the first level with at least KNN_MIN_ROWS,
+    otherwise the widest level found
+
+    Returns:
+        Els and their multiplicities (list of tuples),
+        in a random order, weighted by the multiplicities
+        Level (float) *or* None, if nothing found
+    """
 
     prop_ranges_dict = deepcopy(user_ranges_dict)
 
@@ -20,61 +63,23 @@ def knn_sample(db_handle, user_ranges_dict):
     prop_ranges_dict['i_min'] *= 100
     prop_ranges_dict['i_max'] *= 100
 
-    query = """
-    WITH precise AS (
-    SELECT els FROM {table} WHERE
-        {z_min}::SMALLINT <= z AND z <= {z_max}::SMALLINT AND
-        {y_min}::SMALLINT <= y AND y <= {y_max}::SMALLINT AND
-        {x_min}::SMALLINT <= x AND x <= {x_max}::SMALLINT AND
-        {k_min}::SMALLINT <= k AND k <= {k_max}::SMALLINT AND
-        {w_min}::SMALLINT <= w AND w <= {w_max}::SMALLINT AND
-        {m_min}::SMALLINT <= m AND m <= {m_max}::SMALLINT AND
-        {d_min}::SMALLINT <= d AND d <= {d_max}::SMALLINT AND
-        {t_min}::SMALLINT <= t AND t <= {t_max}::SMALLINT AND
-        {i_min}::SMALLINT <= i AND i <= {i_max}::SMALLINT AND
-        {o_min}::SMALLINT <= o AND o <= {o_max}::SMALLINT
-        LIMIT 3000
-    )
-    SELECT els FROM precise
-    UNION ALL
-    SELECT els FROM {table} WHERE (SELECT COUNT(*) FROM precise)=0 AND
-        ({z_min} - {z_margin})::SMALLINT <= z AND z <= ({z_max} + {z_margin})::SMALLINT AND
-        ({y_min} - {y_margin})::SMALLINT <= y AND y <= ({y_max} + {y_margin})::SMALLINT AND
-        ({x_min} - {x_margin})::SMALLINT <= x AND x <= ({x_max} + {x_margin})::SMALLINT AND
-        ({k_min} - {k_margin})::SMALLINT <= k AND k <= ({k_max} + {k_margin})::SMALLINT AND
-        ({w_min} - {w_margin})::SMALLINT <= w AND w <= ({w_max} + {w_margin})::SMALLINT AND
-        ({m_min} - {m_margin})::SMALLINT <= m AND m <= ({m_max} + {m_margin})::SMALLINT AND
-        ({d_min} - {d_margin})::SMALLINT <= d AND d <= ({d_max} + {d_margin})::SMALLINT AND
-        ({t_min} - {t_margin})::SMALLINT <= t AND t <= ({t_max} + {t_margin})::SMALLINT AND
-        ({i_min} - {i_margin})::SMALLINT <= i AND i <= ({i_max} + {i_margin})::SMALLINT AND
-        ({o_min} - {o_margin})::SMALLINT <= o AND o <= ({o_max} + {o_margin})::SMALLINT
-        LIMIT 3000
-    """.format(
-        table=KNN_TABLE,
-        z_margin=prediction_margins['z'],
-        y_margin=prediction_margins['y'],
-        x_margin=prediction_margins['x'],
-        k_margin=prediction_margins['k'],
-        w_margin=prediction_margins['w'],
-        m_margin=prediction_margins['m'],
-        d_margin=prediction_margins['d'],
-        t_margin=prediction_margins['t'],
-        i_margin=prediction_margins['i'],
-        o_margin=prediction_margins['o'],
-        **prop_ranges_dict
-    )
-    #print(query)
-    db_handle.execute(query)
+    statement = get_prepared_statement(db_handle.connection, KNN_QUERY)
+    rows = statement.run(min_rows=KNN_MIN_ROWS, start=random.random(), **{
+        key: prop_ranges_dict[key] for prop_id in PROP_IDS for key in [prop_id + '_min', prop_id + '_max']
+    })
 
-    result = []
-    for deck in db_handle.fetchall():
-        els = [periodic_elements[periodic_numbers.index(int(pn))] for pn in deck[0].split(',') if int(pn) != 0]
-        result.append(els)
+    levels = {}
+    for deck in rows:
+        levels.setdefault(deck[0], []).append(deck[1])
+    if not levels:
+        return [], None
+
+    n_level = min([n for n in levels if len(levels[n]) >= KNN_MIN_ROWS] or [max(levels)])
+    result = decode_els(encode_els(levels[n_level]))
 
     #print("KNN LENGTH: %s" % len(result))
 
-    random.shuffle(result)
-    return result
+    return result, KNN_LEVELS[n_level]
 
 
 if __name__ == "__main__":
@@ -84,10 +89,8 @@ if __name__ == "__main__":
 
     from pprint import pprint
     import time
-    from common import connect_database
-    from prediction_ranges import prediction_ranges
-
-    cursor, connection = connect_database()
+    from mpds_ml_labs.common import pooled_database
+    from mpds_ml_labs.prediction_ranges import prediction_ranges
 
     sample = {}
 
@@ -101,80 +104,12 @@ if __name__ == "__main__":
             sample[prop_id + '_min'] = prediction_ranges[prop_id][0]
             sample[prop_id + '_max'] = prediction_ranges[prop_id][0] + bound
 
-    for prop_id in ['x', 'w', 't']:
-        # NB. internally treated as *10 to fit SMALLINT
-        sample[prop_id + '_min'] *= 10
-        sample[prop_id + '_max'] *= 10
-
-    # NB. internally treated as *100 to fit SMALLINT
-    sample['i_min'] *= 100
-    sample['i_max'] *= 100
-
-    #for prop_id in ['z', 'y', 'x', 'k', 'w', 'm', 'd', 't', 'i', 'o']:
-    #    print("%s E ( %s --- %s )" % (prop_id, sample[prop_id + '_min'], sample[prop_id + '_max']))
-
-    # duplicate query below as it provides more debug info (precise vs. approx.)
-    query = """
-    WITH precise AS (
-    SELECT els FROM {table} WHERE
-        {z_min}::SMALLINT <= z AND z <= {z_max}::SMALLINT AND
-        {y_min}::SMALLINT <= y AND y <= {y_max}::SMALLINT AND
-        {x_min}::SMALLINT <= x AND x <= {x_max}::SMALLINT AND
-        {k_min}::SMALLINT <= k AND k <= {k_max}::SMALLINT AND
-        {w_min}::SMALLINT <= w AND w <= {w_max}::SMALLINT AND
-        {m_min}::SMALLINT <= m AND m <= {m_max}::SMALLINT AND
-        {d_min}::SMALLINT <= d AND d <= {d_max}::SMALLINT AND
-        {t_min}::SMALLINT <= t AND t <= {t_max}::SMALLINT AND
-        {i_min}::SMALLINT <= i AND i <= {i_max}::SMALLINT AND
-        {o_min}::SMALLINT <= o AND o <= {o_max}::SMALLINT
-        LIMIT 3000
-    )
-    SELECT 1, els FROM precise
-    UNION ALL
-    SELECT 0, els FROM {table} WHERE (SELECT COUNT(*) FROM precise)=0 AND
-        ({z_min} - {z_margin})::SMALLINT <= z AND z <= ({z_max} + {z_margin})::SMALLINT AND
-        ({y_min} - {y_margin})::SMALLINT <= y AND y <= ({y_max} + {y_margin})::SMALLINT AND
-        ({x_min} - {x_margin})::SMALLINT <= x AND x <= ({x_max} + {x_margin})::SMALLINT AND
-        ({k_min} - {k_margin})::SMALLINT <= k AND k <= ({k_max} + {k_margin})::SMALLINT AND
-        ({w_min} - {w_margin})::SMALLINT <= w AND w <= ({w_max} + {w_margin})::SMALLINT AND
-        ({m_min} - {m_margin})::SMALLINT <= m AND m <= ({m_max} + {m_margin})::SMALLINT AND
-        ({d_min} - {d_margin})::SMALLINT <= d AND d <= ({d_max} + {d_margin})::SMALLINT AND
-        ({t_min} - {t_margin})::SMALLINT <= t AND t <= ({t_max} + {t_margin})::SMALLINT AND
-        ({i_min} - {i_margin})::SMALLINT <= i AND i <= ({i_max} + {i_margin})::SMALLINT AND
-        ({o_min} - {o_margin})::SMALLINT <= o AND o <= ({o_max} + {o_margin})::SMALLINT
-        LIMIT 3000
-    """.format(
-        table=KNN_TABLE,
-        z_margin=prediction_margins['z'],
-        y_margin=prediction_margins['y'],
-        x_margin=prediction_margins['x'],
-        k_margin=prediction_margins['k'],
-        w_margin=prediction_margins['w'],
-        m_margin=prediction_margins['m'],
-        d_margin=prediction_margins['d'],
-        t_margin=prediction_margins['t'],
-        i_margin=prediction_margins['i'],
-        o_margin=prediction_margins['o'],
-        **sample
-    )
-
     start_time = time.time()
-    cursor.execute(query)
-    #print(query)
+    with pooled_database() as (cursor, connection):
+        result, level = knn_sample(cursor, sample)
     print("Query done in %1.2f sc" % (time.time() - start_time))
 
-    result = []
-    precise = 0
-
-    for deck in cursor.fetchall():
-        precise = deck[0]
-        els = [periodic_elements[periodic_numbers.index(int(pn))] for pn in deck[1].split(',') if int(pn) != 0]
-        result.append(els)
-
-    print("PRECISE" if precise else "APPROX.")
+    print("Level:", "nothing found" if level is None else level)
     print("Total:", len(result))
 
-    random.shuffle(result)
     pprint(result[:5])
-
-    connection.close()
@@ -0,0 +1,83 @@
+"""
+Single-file storage of the named arrays,
+memory-mapped read-only on loading, so that
+the pages are shared by all the processes
+"""
+import mmap
+import json
+import hashlib
+
+import numpy as np
+
+
+__author__ = 'Evgeny Blokhin <eb@tilde.pro>'
+__copyright__ = 'Copyright (c) 2020, Evgeny Blokhin, Tilde Materials Informatics'
+__license__ = 'LGPL-2.1+'
+
+
+ALIGN = 64 # bytes, so that the arrays are mapped aligned
+
+
+def save_arrays(file_name, magic, arrays, header=None):
+    """
+    Write the magic, the header length, the JSON header
+    (the given one plus the arrays layout and the checksum),
+    then the aligned raw arrays
+    """
+    header = dict(header or {})
+    layout, offset = {}, 0
+    checksum = hashlib.sha256()
+
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        layout[name] = [offset, array.dtype.str, list(array.shape)]
+        checksum.update(array.tobytes())
+        checksum.update(b'\0' * (-array.nbytes % ALIGN))
+        offset += array.nbytes + (-array.nbytes % ALIGN)
+
+    header['arrays'] = layout
+    header['checksum'] = checksum.hexdigest()
+    header = json.dumps(header, default=lambda obj: obj.item()).encode('utf-8')
+    header += b' ' * (-(len(magic) + 8 + len(header)) % ALIGN)
+
+    with open(file_name, 'wb') as f:
+        f.write(magic)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for array in arrays.values():
+            array = np.ascontiguousarray(array)
+            f.write(array.tobytes())
+            f.write(b'\0' * (-array.nbytes % ALIGN))
+
+
+def load_arrays(file_name, magic, verify=False):
+    """
+    Map the file written by save_arrays;
+    the checksum is only verified on demand,
+    since this reads the whole file
+
+    Returns:
+        Arrays (dict of read-only numpy arrays)
+        Header (dict)
+    """
+    with open(file_name, 'rb') as f:
+        buff = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if buff[:len(magic)] != magic:
+        raise RuntimeError('Unexpected file format: %s' % file_name)
+
+    start = len(magic) + 8
+    header_len = int(np.frombuffer(buff, dtype=np.uint64, count=1, offset=len(magic))[0])
+    header = json.loads(buff[start:start + header_len].decode('utf-8'))
+    start += header_len
+
+    if verify and hashlib.sha256(memoryview(buff)[start:]).hexdigest() != header['checksum']:
+        raise RuntimeError('File is corrupted: %s' % file_name)
+
+    arrays = {
+        name: np.frombuffer(
+            buff, dtype=np.dtype(dtype), count=int(np.prod(shape)), offset=start + offset
+        ).reshape(shape)
+        for name, (offset, dtype, shape) in header['arrays'].items()
+    }
+    return arrays, header
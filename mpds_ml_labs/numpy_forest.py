@@ -0,0 +1,259 @@
+"""
+Pure NumPy inference of the random forests,
+as an alternative to the pickled sklearn models
+and treelite's compiled models
+"""
+import numpy as np
+
+from mpds_ml_labs.mmap_arrays import save_arrays, load_arrays
+
+
+__author__ = 'Evgeny Blokhin <eb@tilde.pro>'
+__copyright__ = 'Copyright (c) 2020, Evgeny Blokhin, Tilde Materials Informatics'
+__license__ = 'LGPL-2.1+'
+
+
+BUNDLE_MAGIC = b'MPDSMLB2'
+FOREST_ARRAYS = ['feature', 'threshold', 'children_left', 'children_right', 'value', 'roots', 'classes']
+
+
+class NumpyForest(object):
+    """
+    All the trees of a forest are flattened into the contiguous node arrays,
+    with the children indices global over the forest;
+    the leaves point to themselves, so that a batch of descriptors
+    is traversed over all the trees level by level, in max_depth steps
+    """
+    quantized = False
+
+    def __init__(self, feature, threshold, children_left, children_right, value, roots, max_depth, classes=None):
+        self.feature = feature
+        self.threshold = threshold
+        self.children_left = children_left
+        self.children_right = children_right
+        self.value = value
+        self.roots = roots
+        self.max_depth = max_depth
+        self.classes = classes
+
+    @classmethod
+    def from_sklearn(cls, model):
+        """
+        Flatten the fitted sklearn RandomForestRegressor
+        or RandomForestClassifier
+        """
+        if model.n_outputs_ != 1:
+            raise RuntimeError('Multi-output forests are not supported')
+
+        classes = getattr(model, 'classes_', None)
+
+        feature, threshold, children_left, children_right, value, roots = [], [], [], [], [], []
+        offset, max_depth = 0, 0
+
+        for estimator in model.estimators_:
+            tree = estimator.tree_
+            leaves = tree.children_left == -1
+            nodes = np.arange(tree.node_count) + offset
+
+            feature.append(np.where(leaves, 0, tree.feature))
+            threshold.append(tree.threshold)
+            children_left.append(np.where(leaves, nodes, tree.children_left + offset))
+            children_right.append(np.where(leaves, nodes, tree.children_right + offset))
+
+            if classes is None:
+                value.append(tree.value[:, 0, 0])
+            else: # the votes or their fractions, depending on sklearn version
+                votes = tree.value[:, 0, :]
+                norms = votes.sum(axis=1)[:, None]
+                norms[norms == 0] = 1
+                value.append(votes / norms)
+
+            roots.append(offset)
+            offset += tree.node_count
+            max_depth = max(max_depth, tree.max_depth)
+
+        return cls(
+            np.concatenate(feature).astype(np.intp),
+            np.concatenate(threshold),
+            np.concatenate(children_left).astype(np.intp),
+            np.concatenate(children_right).astype(np.intp),
+            np.concatenate(value),
+            np.array(roots, dtype=np.intp),
+            max_depth,
+            classes
+        )
+
+    def get_arrays(self):
+        arrays = {name: getattr(self, name) for name in FOREST_ARRAYS}
+        if self.classes is None:
+            del arrays['classes']
+        return arrays
+
+    def save(self, file_name):
+        with open(file_name, 'wb') as f:
+            np.savez(f, max_depth=np.array(self.max_depth), quantized=np.array(self.quantized), **self.get_arrays())
+
+    @staticmethod
+    def load(file_name):
+        with np.load(file_name, allow_pickle=False) as arrays:
+            forest_cls = QuantizedForest if 'quantized' in arrays and arrays['quantized'] else NumpyForest
+            return forest_cls(
+                arrays['feature'],
+                arrays['threshold'],
+                arrays['children_left'],
+                arrays['children_right'],
+                arrays['value'],
+                arrays['roots'],
+                int(arrays['max_depth']),
+                arrays['classes'] if 'classes' in arrays else None
+            )
+
+    def get_inputs(self, X):
+        # NB. sklearn compares float32 inputs against float64 thresholds
+        return np.asarray(X, dtype=np.float32)
+
+    def apply(self, X):
+        """
+        Returns:
+            Leaf indices (numpy array, n_trees x n_samples)
+        """
+        X = self.get_inputs(X)
+        samples = np.arange(len(X))
+        nodes = np.repeat(self.roots[:, None], len(X), axis=1)
+
+        for _ in range(self.max_depth):
+            go_left = X[samples, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.children_left[nodes], self.children_right[nodes])
+
+        return nodes
+
+    def predict(self, X):
+        """
+        The same outputs as the sklearn predict,
+        the tree contributions being summed in the same order
+        """
+        leaf_values = self.value[self.apply(X)]
+
+        total = np.zeros(leaf_values.shape[1:])
+        for tree_values in leaf_values:
+            total += tree_values
+        total /= len(self.roots)
+
+        if self.classes is None:
+            return total
+
+        return self.classes.take(np.argmax(total, axis=1), axis=0)
+
+
+class QuantizedForest(NumpyForest):
+    """
+    The NumPy forest with the int16 thresholds (see quantize_forest),
+    compared against the doubled inputs
+    """
+    quantized = True
+
+    def get_inputs(self, X):
+        # NB. doubling is exact in float32
+        return 2 * np.asarray(X, dtype=np.float32)
+
+
+def quantize_forest(model, compact_values=True):
+    """
+    The descriptor is integer-valued, hence the thresholds
+    of the forests trained on it are the half-integers,
+    i.e. the midpoints between the integer feature values.
+    These are stored doubled, as the exact int16 split points;
+    the off-grid thresholds, if any, are floored, which is still exact
+    for the integer inputs (see count_offgrid_thresholds).
+    The regressor node values are optionally stored as float32,
+    which may change the rounded predictions and is to be verified;
+    the classifier votes are kept, since their ties are decided by argmax
+
+    Returns:
+        Quantized model (QuantizedForest)
+    """
+    doubled = np.floor(2 * model.threshold)
+    limits = np.iinfo(np.int16)
+    if doubled.min() < limits.min or doubled.max() > limits.max:
+        raise RuntimeError('Thresholds are outside of the int16 range')
+
+    quantized = QuantizedForest(
+        model.feature.astype(np.int16),
+        doubled.astype(np.int16),
+        model.children_left.astype(np.int32),
+        model.children_right.astype(np.int32),
+        model.value.astype(np.float32) if compact_values and model.classes is None else model.value,
+        model.roots.astype(np.int32),
+        model.max_depth,
+        model.classes
+    )
+    for attr in ['metadata', 'n_features_']:
+        if hasattr(model, attr):
+            setattr(quantized, attr, getattr(model, attr))
+
+    return quantized
+
+
+def count_offgrid_thresholds(model):
+    """
+    Count the thresholds of the internal nodes,
+    which are not the half-integers
+    """
+    internal = model.children_left != np.arange(len(model.children_left))
+    doubled = 2 * model.threshold[internal]
+    return int(np.count_nonzero(doubled != np.floor(doubled)))
+
+
+def save_bundle(ml_models, file_name):
+    """
+    Store the flattened models (see prediction.flatten_ml_models)
+    with their metadata and inputs length
+    in a single file, to be memory-mapped by load_bundle
+    """
+    arrays, header = {}, {'models': {}}
+
+    for prop_id, model in sorted(ml_models.items()):
+        if not isinstance(model, NumpyForest):
+            raise RuntimeError('Model %s is not flattened' % prop_id)
+
+        for name, array in model.get_arrays().items():
+            arrays[prop_id + '/' + name] = array
+
+        header['models'][prop_id] = {
+            'metadata': model.metadata,
+            'n_features': int(model.n_features_),
+            'max_depth': int(model.max_depth),
+            'quantized': model.quantized
+        }
+
+    save_arrays(file_name, BUNDLE_MAGIC, arrays, header)
+
+
+def load_bundle(file_name, verify=False):
+    """
+    Map the bundle file read-only, so that its pages
+    are shared by all the processes loading it
+    (see mmap_arrays)
+
+    Returns:
+        Models (dict)
+    """
+    arrays, header = load_arrays(file_name, BUNDLE_MAGIC, verify=verify)
+
+    ml_models = {}
+    for prop_id, item in header['models'].items():
+        forest_cls = QuantizedForest if item.get('quantized') else NumpyForest
+        ml_models[prop_id] = forest_cls(
+            arrays[prop_id + '/feature'],
+            arrays[prop_id + '/threshold'],
+            arrays[prop_id + '/children_left'],
+            arrays[prop_id + '/children_right'],
+            arrays[prop_id + '/value'],
+            arrays[prop_id + '/roots'],
+            item['max_depth'],
+            arrays.get(prop_id + '/classes')
+        )
+        ml_models[prop_id].metadata = item['metadata']
+        ml_models[prop_id].n_features_ = item['n_features']
+
+    return ml_models
@@ -1,6 +1,12 @@
 
 import os
+import random
+import signal
+import itertools
 import logging
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
 
 import numpy as np
 
@@ -11,6 +17,12 @@ from sklearn.metrics import mean_absolute_error, r2_score, confusion_matrix
 try: import treelite.runtime
 except ImportError: logging.warning('Compiled models not supported')
 
+from mpds_ml_labs.numpy_forest import NumpyForest, load_bundle
+from mpds_ml_labs.common import EVAL_THREADS, DESCRIPTOR_PROCESSES
+
+try: row_dot = np.vecdot # NB. shares the BLAS dot loop with np.dot, hence bit-identical to it
+except AttributeError: row_dot = lambda a, b: np.einsum('ij,ij->i', a, b)
+
 
 __author__ = 'Evgeny Blokhin <eb@tilde.pro>'
 __copyright__ = 'Copyright (c) 2020, Evgeny Blokhin, Tilde Materials Informatics'
@@ -118,86 +130,498 @@ periodic_numbers = [0,
 6,   12,    16,    18,   20,  22,   24,    26,   28,   30,   32,   34,   36,   38,   40,  42,   44,    48,   52,   56,   60,   64,   68,   72,   76,   80,   86,   92,   98,  104,  110,  117,
 7,   13,    17,    19,   21,  23,   25,    27,   29,   31,   33,   35,   37,   39,   41,  43,   45,    49,   53,   57,   61,   65,   69,   73,   77,   81,   87,   93,   99,  105,  111,  118]
 
+periodic_numbers_lut = np.array(periodic_numbers) - 1 # NB. indexed by atomic number
+periodic_elements_lut = np.array(periodic_elements, dtype=object)[np.argsort(periodic_numbers)] # NB. indexed by periodic number
+
 MIN_DESCRIPTOR_LEN = 100
+MAX_SPHERE_ATOMS = 500000 # memory cap while populating the descriptor volume
+MAX_BOX_ATOMS = 20000000 # work cap for the center of mass of the volume, never built at once
 N_ITER_DISORDER = 6 # the more iterations, the more consistent the ML prediction,
                     # but the more expensive the calculation
+N_ITER_TEMPLATE = 30 # the same for the geometry templates, where an iteration is cheap
+DISORDER_MODE = 'random' # or 'template', or 'expected', see get_ordered_descriptor
+eval_pool, eval_pool_lock = None, threading.Lock() # see get_eval_pool
+descriptor_pool = None # see start_descriptor_pool
+MIN_POOLED_STRUCTURES = 16 # fewer structures are not worth sending to the processes
 
 
-def get_descriptor(ase_obj, kappa=None, overreach=False):
+def get_descriptor(ase_obj, kappa=None, overreach=False, n_atoms=None):
     """
     From ASE object obtain
     a vectorized atomic structure
     populated to a certain fixed (relatively big) volume
-    defined by kappa
+    defined by kappa;
+    optionally only n_atoms nearest atoms are kept
     """
     if not kappa: kappa = 18
     if overreach: kappa *= 2
 
-    norms = np.array([ np.linalg.norm(vec) for vec in ase_obj.get_cell() ])
-    multiple = np.ceil(kappa / norms).astype(int)
-    ase_obj = ase_obj.repeat(multiple)
-    com = ase_obj.get_center_of_mass()
-    ase_obj.translate(-com)
-    del ase_obj[
-        [atom.index for atom in ase_obj if np.sqrt(np.dot(atom.position, atom.position)) > kappa]
-    ]
+    positions, sites, supercell = get_sphere_atoms(ase_obj, kappa)
+
+    return descriptor_kernel(positions, ase_obj.numbers[sites], supercell, n_atoms=n_atoms)
+
+
+def get_descriptor_len(ml_models):
+    """
+    Number of atoms in the descriptor, enough for
+    all the given models, since the models take their features
+    from the beginning of the flattened descriptor
+    """
+    if not ml_models:
+        return None
+
+    return max([MIN_DESCRIPTOR_LEN] + [model.n_features_ for model in ml_models.values()])
+
+
+def get_sphere_multiple(cell, kappa, repeat=None):
+    """
+    Number of the cells along each vector embracing kappa,
+    in the whole repeats of the cell, if given
+
+    Returns:
+        3 multiples (int array)
+    """
+    norms = np.array([ np.linalg.norm(vec) for vec in cell ])
+    if repeat is None:
+        return np.ceil(kappa / norms).astype(int)
+
+    return np.ceil(kappa / (norms * repeat)).astype(int) * repeat
+
+
+def get_sphere_atoms(ase_obj, kappa, max_atoms=MAX_SPHERE_ATOMS, repeat=None):
+    """
+    Populate the kappa sphere around the center of mass
+    of the supercell embracing kappa, without building that supercell
+    as ASE object. Its cells are enumerated in the order of
+    ase's Atoms.repeat in the blocks of at most max_atoms:
+    the first pass takes the center of mass, the second one
+    only builds the cells reaching into the sphere.
+    NB. if the supercell fits a single block, its center of mass
+    is the same sum as in ase, so the descriptor is bit-identical
+    to the ase's supercell; otherwise it may differ in the last bits
+
+    Args:
+        ase_obj: (object) ASE structure
+        kappa: (float) sphere radius
+        max_atoms: (int) memory cap for the atoms built at once
+        repeat: (array) treat ase_obj as repeated that many times along each vector
+
+    Returns:
+        N x 3 cartesian positions (array), relative to the center of mass
+        N indices of the atoms in ase_obj (array), in the supercell order
+        3 x 3 supercell matrix (array)
+
+    Raises RuntimeError, if max_atoms of the cells reaching into the sphere
+    or MAX_BOX_ATOMS of the supercell are exceeded
+    """
+    cell = np.array(ase_obj.get_cell())
+    multiple = get_sphere_multiple(cell, kappa, repeat=repeat)
+    masses, n_sites = ase_obj.get_masses(), len(ase_obj)
+
+    n_cells = int(np.prod(multiple))
+    if n_cells * n_sites > MAX_BOX_ATOMS:
+        raise RuntimeError('Crystal cell is too small or too skewed for the descriptor')
+
+    block = max(1, max_atoms // n_sites)
+    blocks = [(start, min(start + block, n_cells)) for start in range(0, n_cells, block)]
+
+    def get_translations(start, end):
+        # NB. equal to ase's np.dot(translation, cell), in the order of Atoms.repeat
+        return np.array(np.unravel_index(np.arange(start, end), multiple)).T @ cell
+
+    def get_cell_positions(translations):
+        positions = np.tile(ase_obj.positions, (len(translations), 1))
+        positions += np.repeat(translations, n_sites, axis=0)
+        return positions
+
+    com = np.zeros(3)
+    for start, end in blocks:
+        com += np.tile(masses, end - start) @ get_cell_positions(get_translations(start, end))
+    com /= np.tile(masses, n_cells).sum() if len(blocks) == 1 else masses.sum() * n_cells
+
+    # the cells are bounded by the sphere around the middle of their atoms
+    lower, upper = ase_obj.positions.min(axis=0), ase_obj.positions.max(axis=0)
+    middle = (lower + upper) / 2
+    reach = (kappa + np.linalg.norm(upper - lower) / 2) * (1 + 1E-9)
+
+    all_positions, all_sites, n_atoms = [], [], 0
+    for start, end in blocks:
+        translations = get_translations(start, end)
+        offsets = translations + (middle - com)
+        translations = translations[row_dot(offsets, offsets) <= reach**2]
 
-    ase_obj.center()
-    ase_obj.set_pbc((False, False, False))
-    sorted_seq = np.argsort(np.fromiter((np.sqrt(np.dot(x, x)) for x in ase_obj.positions), np.float))
-    ase_obj = ase_obj[sorted_seq]
+        n_atoms += len(translations) * n_sites
+        if n_atoms > max_atoms:
+            raise RuntimeError('Crystal cell is too small or too skewed for the descriptor')
 
-    elements, positions = [], []
-    for atom in ase_obj:
-        elements.append(periodic_numbers[periodic_elements.index(atom.symbol)] - 1)
-        positions.append(int(round(np.sqrt(atom.position[0]**2 + atom.position[1]**2 + atom.position[2]**2) * 10)))
+        positions = get_cell_positions(translations)
+        positions -= com
+        inside = np.sqrt(row_dot(positions, positions)) <= kappa
+        all_positions.append(positions[inside])
+        all_sites.append(np.tile(np.arange(n_sites), len(translations))[inside])
 
-    return np.array([elements, positions])
+    return np.concatenate(all_positions), np.concatenate(all_sites), cell * multiple[:, None]
 
 
-def get_ordered_descriptor(ase_obj, kappa=None, overreach=False):
+def descriptor_kernel(positions, numbers, cell, n_atoms=None):
+    """
+    NumPy-only core of the descriptor:
+    center the atoms of the kappa sphere in the cell
+    (as ase's Atoms.center does) and sort them
+    by the lengths of the radius-vectors;
+    if only n_atoms are needed, the first ones are kept
+
+    Args:
+        positions: (array) N x 3 cartesian positions
+        numbers: (array) N atomic numbers
+        cell: (array) 3 x 3 cell matrix of the populated volume
+        n_atoms: (int) number of the nearest atoms to keep, or None for all
+
+    Returns:
+        2 x min(N, n_atoms) descriptor (array): periodic numbers and radii (*10)
+    """
+    sorted_seq, radii = get_radial_order(positions, cell, n_atoms=n_atoms)
+
+    return np.array([periodic_numbers_lut[numbers[sorted_seq]], radii])
+
+
+def get_radial_order(positions, cell, n_atoms=None):
+    """
+    Center the atoms in the cell and find their order
+    by the lengths of the radius-vectors
+
+    Returns:
+        Order of the atoms (array)
+        Their radii (*10) in this order (array)
+    """
+    positions = positions + get_centering(positions, cell)
+    distances = np.sqrt(row_dot(positions, positions))
+
+    # NB. the order of the equidistant atoms is that of the full argsort,
+    # which a partial sort cannot reproduce, so only its result is truncated
+    sorted_seq = np.argsort(distances)[:n_atoms or None]
+
+    positions = positions[sorted_seq]
+    radii = np.sqrt(positions[:, 0]**2 + positions[:, 1]**2 + positions[:, 2]**2)
+
+    return sorted_seq, np.rint(radii * 10).astype(int)
+
+
+def get_centering(positions, cell):
+    """
+    Translation vector putting the bounding box
+    of the atoms in the middle of the cell,
+    i.e. ase's Atoms.center() without vacuum
+    """
+    lengths = np.linalg.norm(cell, axis=1)
+    translation = np.zeros(3)
+
+    for i in range(3):
+        direction = np.cross(cell[i - 1], cell[i - 2])
+        direction /= np.linalg.norm(direction)
+        if direction @ cell[i] < 0.0:
+            direction *= -1
+
+        if len(positions):
+            scalarprod = positions @ direction
+            p0, p1 = scalarprod.min(), scalarprod.max()
+        else:
+            p0, p1 = 0, 0
+
+        height = cell[i] @ direction
+        shift = 0.5 * ((height - p1) - p0) / (height / lengths[i])
+        translation += shift * cell[i] / lengths[i]
+
+    return translation
+
+
+def get_ordered_descriptor(ase_obj, kappa=None, overreach=False, n_atoms=None, disorder=None, rng=random):
+    """
+    Average descriptor of several random orderings
+    of a disordered structure; these are either built
+    one by one (*random* mode) or relabeled from a shared
+    geometry template (*template* mode). Alternatively,
+    the exact average is obtained from the occupancies
+    (*expected* mode). The orderings are averaged uniformly,
+    and they are reproducible with a seeded rng, e.g. random.Random(seed)
+    """
     if 'disordered' not in ase_obj.info:
         return None, "Expected disordered structure, got ordered structure"
 
-    from mpds_ml_labs.struct_utils import order_disordered
+    if not disorder: disorder = DISORDER_MODE
+
+    if disorder == 'expected':
+        return get_expected_descriptor(ase_obj, kappa=kappa, overreach=overreach, n_atoms=n_atoms)
+
+    elif disorder == 'template':
+        template, error = get_disorder_template(ase_obj, kappa=kappa, overreach=overreach)
+        if error: return None, error
+
+        descriptors = (realize_template(template, n_atoms=n_atoms, rng=rng) for _ in range(N_ITER_TEMPLATE))
+
+    elif disorder == 'random':
+        descriptors = (get_random_descriptor(ase_obj, kappa=kappa, overreach=overreach, n_atoms=n_atoms, rng=rng) for _ in range(N_ITER_DISORDER))
 
-    descriptor = None
-    for _ in range(N_ITER_DISORDER):
-        order_obj, error = order_disordered(ase_obj)
+    else: return None, "Unknown disorder mode: %s" % disorder
+
+    realizations = []
+    for interim_descriptor, error in descriptors:
         if error: return None, error
+        realizations.append(interim_descriptor)
+
+    # NB. all the realizations weigh the same, aligned to the shortest one
+    min_len = min(len(realization[0]) for realization in realizations)
+
+    return np.mean(np.stack([realization[:, :min_len] for realization in realizations]), axis=0), None
+
+
+def get_random_descriptor(ase_obj, kappa=None, overreach=False, n_atoms=None, rng=random):
+
+    from mpds_ml_labs.struct_utils import order_disordered
+
+    order_obj, error = order_disordered(ase_obj, rng=rng)
+    if error: return None, error
+
+    return get_aligned_descriptor(order_obj, kappa=kappa, overreach=overreach, n_atoms=n_atoms)
+
+
+def get_disorder_template(ase_obj, kappa=None, overreach=False):
+    """
+    Build once the geometry shared by all the random orderings
+    of a disordered structure: the supercell, its kappa sphere
+    and the radial order of the sphere atoms. Every site is kept,
+    and the center of mass is taken with the occupancy-averaged masses,
+    so that the geometry does not depend on a particular ordering.
+
+    Returns:
+        Template (dict) *or* None
+        None *or* error (str)
+    """
+    from ase.data import atomic_numbers
+    from mpds_ml_labs.struct_utils import get_disorder_supercell
+
+    supercell_matrix, species, error = get_disorder_supercell(ase_obj)
+    if error: return None, error
+
+    masses, _, occupied, error = get_site_occupancies(ase_obj)
+    if error: return None, error
+
+    template_obj = ase_obj.copy()
+    template_obj *= supercell_matrix
+    del template_obj.info['disordered']
+
+    det = len(template_obj) // len(ase_obj)
+    template_obj.set_masses(np.tile(masses, det))
+
+    disorder = []
+    for index in ase_obj.info['disordered']:
+        # NB. reversed order, as in order_disordered
+        at_indices = np.flatnonzero(template_obj.get_tags() == index)[::-1]
+        disorder.append((at_indices, [atomic_numbers[el] for el in species[index]]))
+
+    sphere, error = get_occupied_sphere(template_obj, np.tile(occupied, det), kappa=kappa, overreach=overreach)
+    if error: return None, error
+
+    positions, sites, supercell = sphere
+    sorted_seq, radii = get_radial_order(positions, supercell)
+
+    return {
+        'numbers': template_obj.numbers,
+        'disorder': disorder,
+        'sites': sites[sorted_seq],
+        'radii': radii
+    }, None
+
+
+def get_site_occupancies(ase_obj):
+    """
+    Occupancy-weighted characteristics of the atoms
+    of a disordered structure, where the vacancies (X)
+    count as nothing
+
+    Returns:
+        Masses (array) *or* None
+        Summed occupancy-weighted periodic numbers - 1 (array) *or* None
+        Occupancies (array) *or* None
+        None *or* error (str)
+    """
+    from ase.data import atomic_numbers, atomic_masses
 
-        interim_descriptor = get_descriptor(order_obj, kappa=kappa, overreach=overreach)
-        if len(interim_descriptor[0]) < MIN_DESCRIPTOR_LEN:
+    masses = ase_obj.get_masses()
+    elements = periodic_numbers_lut[ase_obj.numbers].astype(float)
+    occupied = np.ones(len(ase_obj))
+
+    for index, occs in ase_obj.info['disordered'].items():
+        try:
+            occs = [(atomic_numbers[el], occ) for el, occ in occs.items() if el != 'X']
+        except KeyError as exc:
+            return None, None, None, 'Unrecognized atom symbol: %s' % exc
+
+        at_indices = ase_obj.get_tags() == index
+        masses[at_indices] = sum([atomic_masses[number] * occ for number, occ in occs])
+        elements[at_indices] = sum([periodic_numbers_lut[number] * occ for number, occ in occs])
+        occupied[at_indices] = sum([occ for _, occ in occs])
+
+    return masses, elements, occupied, None
+
+
+def get_occupied_sphere(ase_obj, occupied, kappa=None, overreach=False, repeat=None):
+    """
+    get_sphere_atoms for the partially occupied atoms,
+    overreaching kappa if needed, as get_aligned_descriptor does
+
+    Returns:
+        Result of get_sphere_atoms (tuple) *or* None
+        None *or* error (str)
+    """
+    if not kappa: kappa = 18
+    if overreach: kappa *= 2
+
+    try:
+        sphere = get_sphere_atoms(ase_obj, kappa, repeat=repeat)
+        if occupied[sphere[1]].sum() < MIN_DESCRIPTOR_LEN:
             if overreach:
                 return None, "Cannot get proper descriptor"
 
-            interim_descriptor = get_descriptor(order_obj, kappa=kappa, overreach=True)
-            if len(interim_descriptor[0]) < MIN_DESCRIPTOR_LEN:
+            sphere = get_sphere_atoms(ase_obj, kappa * 2, repeat=repeat)
+            if occupied[sphere[1]].sum() < MIN_DESCRIPTOR_LEN:
                 return None, "Cannot get proper descriptor"
 
-        if descriptor is not None:
-            left_len, right_len = len(descriptor[0]), len(interim_descriptor[0])
+    except RuntimeError as e:
+        return None, str(e)
 
-            if left_len != right_len: # align length
-                descriptor =         descriptor[:, :min(left_len, right_len)]
-                interim_descriptor = interim_descriptor[:, :min(left_len, right_len)]
+    return sphere, None
 
-            descriptor = (descriptor + interim_descriptor)/2
-        else:
-            descriptor = interim_descriptor[:]
 
-    return descriptor, None
+def realize_template(template, n_atoms=None, rng=random):
+    """
+    Descriptor of one random ordering:
+    the species are shuffled over the disordered sites
+    of the template, and the vacancies are masked out
+    """
+    numbers = template['numbers'].copy()
+    for at_indices, species in template['disorder']:
+        species = species[:]
+        rng.shuffle(species)
+        numbers[at_indices] = np.resize(species, len(at_indices))
+
+    numbers = numbers[template['sites']]
+    occupied = numbers != 0 # NB. vacancies (X)
+
+    return np.array([
+        periodic_numbers_lut[numbers[occupied]][:n_atoms],
+        template['radii'][occupied][:n_atoms]
+    ]), None
+
+
+def get_expected_descriptor(ase_obj, kappa=None, overreach=False, n_atoms=None):
+    """
+    Expected descriptor of a disordered structure over its orderings,
+    obtained right from the partial occupancies, without
+    any supercell and random shuffles. The kappa sphere is populated
+    from the original cell as if it were the ordering supercell;
+    then, going outwards, a probability distribution of the number
+    of the occupied atoms met so far gives the probabilities of every atom
+    to take every place in the descriptor. This distribution is only kept
+    up to n_atoms places, so every partially occupied atom costs O(n_atoms),
+    and the whole pass is O(n_atoms) per atom of the sphere.
+    NB. for the tiny occupancies, the sphere repeating the ordering supercell
+    exceeds MAX_BOX_ATOMS; then it is populated from the original cell,
+    which only moves the center of mass
+
+    Returns:
+        Descriptor (array) *or* None
+        None *or* error (str)
+    """
+    from mpds_ml_labs.struct_utils import get_disorder_supercell
+
+    supercell_matrix, _, error = get_disorder_supercell(ase_obj, max_atoms=None)
+    if error: return None, error
+
+    masses, elements, occupied, error = get_site_occupancies(ase_obj)
+    if error: return None, error
+
+    lattice_obj = ase_obj.copy()
+    lattice_obj.set_masses(masses)
+
+    # NB. get_occupied_sphere may double kappa at most
+    repeat = np.array(supercell_matrix)
+    multiple = get_sphere_multiple(np.array(ase_obj.get_cell()), (kappa or 18) * 2, repeat=repeat)
+    if np.prod(multiple) * len(ase_obj) > MAX_BOX_ATOMS:
+        repeat = None
+
+    sphere, error = get_occupied_sphere(lattice_obj, occupied, kappa=kappa, overreach=overreach, repeat=repeat)
+    if error: return None, error
+
+    positions, sites, supercell = sphere
+    sorted_seq, radii = get_radial_order(positions, supercell)
+    sites = sites[sorted_seq]
+    elements, occupied = elements[sites], occupied[sites]
 
+    n_places = int(occupied.sum())
+    if n_atoms:
+        n_places = min(n_places, n_atoms)
 
-def get_aligned_descriptor(ase_obj, kappa=None):
+    # NB. runs of the fully occupied atoms just shift the distribution
+    partial = np.flatnonzero(occupied < 1)
+    bounds = np.concatenate([[0], np.repeat(partial, 2), [len(sites)]]).reshape(-1, 2)
+    bounds[1:, 0] += 1
 
-    descriptor = get_descriptor(ase_obj, kappa=kappa)
-    if len(descriptor[0]) < MIN_DESCRIPTOR_LEN:
-        descriptor = get_descriptor(ase_obj, kappa=kappa, overreach=True)
-        if len(descriptor[0]) < MIN_DESCRIPTOR_LEN:
-            return None, "Cannot get proper descriptor"
+    distrib, offset = np.ones(1), 0 # probabilities of 0, 1, ... occupied atoms before
+    weights, expected_els, expected_radii = np.zeros((3, n_places + len(sites) + 1))
 
-    return descriptor, None
+    for n, (start, end) in enumerate(bounds):
+        if start < end:
+            span = offset + np.arange(len(distrib) + end - start - 1)
+            weights[span] += np.convolve(distrib, np.ones(end - start))
+            expected_els[span] += np.convolve(distrib, elements[start:end])
+            expected_radii[span] += np.convolve(distrib, radii[start:end])
+            offset += end - start
+
+        if offset >= n_places or n == len(partial):
+            break
+
+        at = partial[n]
+        span = offset + np.arange(len(distrib))
+        weights[span] += distrib * occupied[at]
+        expected_els[span] += distrib * elements[at]
+        expected_radii[span] += distrib * occupied[at] * radii[at]
+        distrib = np.append(distrib * (1 - occupied[at]), 0) + np.insert(distrib * occupied[at], 0, 0)
+        # NB. the atoms preceded by n_places occupied ones never get into the descriptor
+        distrib = distrib[:n_places - offset]
+
+    weights = weights[:n_places]
+    if not weights.all():
+        return None, "Cannot get proper descriptor"
+
+    return np.array([expected_els[:n_places] / weights, expected_radii[:n_places] / weights]), None
+
+
+def get_aligned_descriptor(ase_obj, kappa=None, overreach=False, n_atoms=None):
+    """
+    Get the descriptor of at least MIN_DESCRIPTOR_LEN atoms,
+    overreaching kappa if needed; the short sphere is detected
+    by its atom count, before any centering and sorting.
+    NB the overreached sphere has another center of mass,
+    so the first pass atoms cannot be just reused
+    """
+    if not kappa: kappa = 18
+    if overreach: kappa *= 2
+
+    try:
+        positions, sites, supercell = get_sphere_atoms(ase_obj, kappa)
+        if len(sites) < MIN_DESCRIPTOR_LEN:
+            if overreach:
+                return None, "Cannot get proper descriptor"
+
+            positions, sites, supercell = get_sphere_atoms(ase_obj, kappa * 2)
+            if len(sites) < MIN_DESCRIPTOR_LEN:
+                return None, "Cannot get proper descriptor"
+
+    except RuntimeError as e:
+        return None, str(e)
+
+    return descriptor_kernel(positions, ase_obj.numbers[sites], supercell, n_atoms=n_atoms), None
 
 
 def load_ml_models(prop_model_files, debug=True):
@@ -212,6 +636,14 @@ def load_ml_models(prop_model_files, debug=True):
             continue
 
         basename = file_name.split(os.sep)[-1]
+        if basename.endswith('.bundle'): # see model_bundler.py
+            bundle = load_bundle(file_name)
+            if debug:
+                for prop_id, model in sorted(bundle.items()):
+                    print("Model-%s from bundle %s metadata: %s" % (prop_id, basename, model.metadata))
+            ml_models.update(bundle)
+            continue
+
         if basename.startswith('ml') and basename[3:4] == '_':
             prop_id = basename[2:3]
             if debug:
@@ -225,6 +657,8 @@ def load_ml_models(prop_model_files, debug=True):
         with open(file_name, 'rb') as f:
             model = cPickle.load(f)
             if hasattr(model, 'predict') and hasattr(model, 'metadata'):
+                if EVAL_THREADS > 1 and hasattr(model, 'n_jobs'):
+                    model.n_jobs = 1 # NB. the models are run concurrently instead, see submit_evaluation
                 ml_models[prop_id] = model
                 if debug:
                     print("Model-%s %s metadata: %s" % (prop_id, basename, model.metadata))
@@ -238,9 +672,10 @@ def load_ml_models(prop_model_files, debug=True):
 def load_comp_models(prop_model_files, orig_models):
     """
     This is a modified loader interface
-    for treelite's compiled models,
+    for treelite's compiled models (*.so)
+    or the flattened NumPy forests (*.npz, see model_flattener.py),
     to replace (swap) loaded sklearn models
-    NB model_comparator.py
+    NB model_comparator.py, forest_comparator.py
     """
     print("Replacing the pure-Python models with the compiled models:")
     print([(prop_id, model.metadata) for prop_id, model in orig_models.items()])
@@ -252,17 +687,40 @@ def load_comp_models(prop_model_files, orig_models):
 
         metadata = orig_models[prop_id].metadata
         n_features = orig_models[prop_id].n_features_
-        orig_models[prop_id] = treelite.runtime.Predictor(modfile, verbose=False)
+
+        if modfile.endswith('.npz'):
+            orig_models[prop_id] = NumpyForest.load(modfile)
+        else:
+            orig_models[prop_id] = treelite.runtime.Predictor(modfile, verbose=False)
+            orig_models[prop_id].treelite = True
+
         orig_models[prop_id].metadata = metadata
         orig_models[prop_id].n_features_ = n_features
-        orig_models[prop_id].treelite = True
 
-    assert all([hasattr(model, 'treelite') for model in orig_models.values()])
+    assert all([hasattr(model, 'treelite') or isinstance(model, NumpyForest) for model in orig_models.values()])
     print([(prop_id, model.metadata) for prop_id, model in orig_models.items()])
 
     return orig_models
 
 
+def flatten_ml_models(orig_models):
+    """
+    Replace (swap) loaded sklearn models
+    with the NumPy forests in memory,
+    i.e. no flattened files are needed
+    """
+    for prop_id, model in orig_models.items():
+        if isinstance(model, NumpyForest):
+            continue
+
+        metadata, n_features = model.metadata, model.n_features_
+        orig_models[prop_id] = NumpyForest.from_sklearn(model)
+        orig_models[prop_id].metadata = metadata
+        orig_models[prop_id].n_features_ = n_features
+
+    return orig_models
+
+
 def get_legend(pred_dict):
     legend = {}
     for key in pred_dict.keys():
@@ -276,54 +734,144 @@ def get_legend(pred_dict):
     return legend
 
 
-def ase_to_prediction(ase_obj, ml_models, prop_ids=False):
+def get_structure_descriptors(ase_obj, n_atoms, disorder=None):
     """
-    Higher-level prediction handler that is able to
-    resolve disordered structures
+    The descriptors, which predict a structure: a single one for the ordered structures
+    and in the expected disorder mode, several ones to be averaged in the other modes
+    (see get_ordered_descriptor on the disorder modes)
 
     Returns:
-        Prediction (dict) *or* None
+        Descriptors (list) *or* None
         None *or* error (str)
     """
     if 'disordered' in ase_obj.info:
 
-        from mpds_ml_labs.struct_utils import order_disordered
+        if not disorder: disorder = DISORDER_MODE
 
-        results, avg_results = {}, {}
-        for _ in range(N_ITER_DISORDER):
-            order_obj, error = order_disordered(ase_obj)
+        if disorder == 'expected':
+            descriptor, error = get_expected_descriptor(ase_obj, n_atoms=n_atoms)
             if error:
                 return None, error
 
-            sample, error = ase_to_prediction(order_obj, ml_models, prop_ids)
+            return [descriptor], None
+
+        elif disorder == 'template':
+            template, error = get_disorder_template(ase_obj)
             if error:
                 return None, error
 
-            for prop_id, pdata in sample.items():
-                avg_results.setdefault(prop_id, []).append(pdata['value'])
+            # NB. the realizations are cheap and evaluated in a single batch, hence more of them
+            return [realize_template(template, n_atoms=n_atoms)[0] for _ in range(N_ITER_TEMPLATE)], None
 
-        # testing
-        if not ml_models:
-            logging.warning('No models loaded, yielding zeros in testing purposes (disordered case)')
-            return {prop_id: {'value': 0, 'mae': 0, 'r2': 0} for prop_id in list(prop_models.keys())}, None
+        elif disorder == 'random':
+            descriptors = []
+            for _ in range(N_ITER_DISORDER):
+                descriptor, error = get_random_descriptor(ase_obj, n_atoms=n_atoms)
+                if error:
+                    return None, error
+                descriptors.append(descriptor)
 
-        for prop_id, values in avg_results.items():
-            if prop_id == 'w' and values.count(0) == 1: # considering classifier error
-                values.remove(0)
+            return descriptors, None
 
-            results[prop_id] = {
-                'value': round(np.median(values), prop_models[prop_id]['rounding']),
-                'mae': round(ml_models[prop_id].metadata['mae'], prop_models[prop_id]['rounding']),
-                'r2': ml_models[prop_id].metadata['r2']
-            }
+        else: return None, "Unknown disorder mode: %s" % disorder
+
+    descriptor, error = get_aligned_descriptor(ase_obj, n_atoms=n_atoms)
+    if error:
+        return None, error
+
+    return [descriptor], None
+
+
+def average_predictions(samples, ml_models):
+    """
+    The median prediction over the realizations of a disordered structure
+    """
+    # testing
+    if not ml_models:
+        logging.warning('No models loaded, yielding zeros in testing purposes (disordered case)')
+        return {prop_id: {'value': 0, 'mae': 0, 'r2': 0} for prop_id in list(prop_models.keys())}
+
+    results, avg_results = {}, {}
+    for sample in samples:
+        for prop_id, pdata in sample.items():
+            avg_results.setdefault(prop_id, []).append(pdata['value'])
+
+    for prop_id, values in avg_results.items():
+        if prop_id == 'w' and values.count(0) == 1: # considering classifier error
+            values.remove(0)
+
+        results[prop_id] = {
+            'value': round(np.median(values), prop_models[prop_id]['rounding']),
+            'mae': round(ml_models[prop_id].metadata['mae'], prop_models[prop_id]['rounding']),
+            'r2': ml_models[prop_id].metadata['r2']
+        }
+
+    return results
+
+
+def ase_to_prediction(ase_obj, ml_models, prop_ids=False, disorder=None):
+    """
+    Higher-level prediction handler that is able to
+    resolve disordered structures (see get_ordered_descriptor
+    on the disorder modes)
+
+    Returns:
+        Prediction (dict) *or* None
+        None *or* error (str)
+    """
+    predictions, error = ase_to_predictions([ase_obj], ml_models, prop_ids, disorder)
+    if error:
+        return None, error
+
+    return predictions[0], None
 
-        return results, None
 
-    descriptor, error = get_aligned_descriptor(ase_obj)
+def ase_to_predictions(ase_objs, ml_models, prop_ids=False, disorder=None):
+    """
+    The same as ase_to_prediction for many structures at once:
+    the descriptors of all the structures (on the process pool, if there are many)
+    are evaluated in a single batch, see get_batch_prediction
+
+    Returns:
+        Predictions (list of dicts, in the order of structures) *or* None
+        None *or* error (str), the first one in the order of structures
+    """
+    if not ase_objs:
+        return [], None
+
+    n_atoms = get_descriptor_len(ml_models)
+    if not disorder: disorder = DISORDER_MODE # NB. resolved here, not in the pool processes
+
+    pool = descriptor_pool
+    if pool is not None and len(ase_objs) >= MIN_POOLED_STRUCTURES:
+        descriptor_sets = list(pool.map(
+            get_structure_descriptors, ase_objs, [n_atoms] * len(ase_objs), [disorder] * len(ase_objs),
+            chunksize=max(1, len(ase_objs) // (4 * DESCRIPTOR_PROCESSES))
+        ))
+    else:
+        descriptor_sets = [get_structure_descriptors(ase_obj, n_atoms, disorder) for ase_obj in ase_objs]
+
+    descriptors = []
+    for descriptor_set, error in descriptor_sets:
+        if error:
+            return None, error
+        descriptors += descriptor_set
+
+    samples, error = get_batch_prediction(descriptors, ml_models, prop_ids)
     if error:
         return None, error
 
-    return get_prediction(descriptor, ml_models, prop_ids)
+    results, start = [], 0
+    for ase_obj, (descriptor_set, _) in zip(ase_objs, descriptor_sets):
+        structure_samples = samples[start:start + len(descriptor_set)]
+        start += len(descriptor_set)
+
+        if 'disordered' in ase_obj.info and disorder != 'expected':
+            results.append(average_predictions(structure_samples, ml_models))
+        else:
+            results.append(structure_samples[0])
+
+    return results, None
 
 
 def get_prediction(descriptor, ml_models, prop_ids=False):
@@ -337,6 +885,25 @@ def get_prediction(descriptor, ml_models, prop_ids=False):
         Prediction (dict) *or* None
         None *or* error (str)
     """
+    predictions, error = get_batch_prediction([descriptor], ml_models, prop_ids)
+    if error:
+        return None, error
+
+    return predictions[0], None
+
+
+def get_batch_prediction(descriptors, ml_models, prop_ids=False):
+    """
+    Execute all the regressor models against many structure descriptors at once,
+    with a single model invocation per property for the whole batch;
+    the descriptors shorter than the model input are skipped by this model,
+    the longer ones are truncated to the model input.
+    The "w" regressor model is gated by the "0" classifier model as in get_prediction
+
+    Returns:
+        Predictions (list of dicts, in the order of descriptors) *or* None
+        None *or* error (str)
+    """
     if not prop_ids:
         prop_ids = list(ml_models.keys())
 
@@ -346,59 +913,63 @@ def get_prediction(descriptor, ml_models, prop_ids=False):
     # testing
     if not ml_models:
         logging.warning('No models loaded, yielding zeros in testing purposes')
-        return {prop_id: {'value': 0, 'mae': 0, 'r2': 0} for prop_id in list(prop_models.keys())}, None
+        return [
+            {prop_id: {'value': 0, 'mae': 0, 'r2': 0} for prop_id in list(prop_models.keys())}
+            for _ in descriptors
+        ], None
 
     if not set(prop_ids).issubset(ml_models.keys()):
         return None, 'Unrecognized model: ' + ', '.join(prop_ids)
 
-    result = {}
-    descriptor = descriptor.flatten()
-    d_dim = len(descriptor)
+    results = [{} for _ in descriptors]
+    descriptors = [descriptor.flatten() for descriptor in descriptors]
+    d_dims = np.array([len(descriptor) for descriptor in descriptors], dtype=int)
+    gated = np.zeros(len(descriptors), dtype=bool)
 
-    if 'w' in prop_ids: # classifier invocation
+    if 'w' in prop_ids: # classifier invocation, always first
         if '0' not in ml_models:
             return None, 'Classifier model is required but not available'
-        if '0' not in prop_ids:
-            prop_ids.append('0')
+        prop_ids = ['0'] + [prop_id for prop_id in prop_ids if prop_id != '0']
 
-    # production
-    for prop_id in prop_ids:
+    def submit(prop_id):
+        n_features = ml_models[prop_id].n_features_
+        mask = d_dims >= n_features
+        if prop_id == 'w':
+            mask &= ~gated
 
-        if prop_id == 'w' and result.get('w', {}).get('value') == 0:
-            continue
+        rows = np.flatnonzero(mask)
+        if not len(rows):
+            return None
 
-        if d_dim < ml_models[prop_id].n_features_:
-            continue
-        elif d_dim > ml_models[prop_id].n_features_:
-            d_input = descriptor[:ml_models[prop_id].n_features_]
-        else:
-            d_input = descriptor[:]
+        d_input = np.array([descriptors[n][:n_features] for n in rows])
+        return rows, submit_evaluation(ml_models[prop_id], d_input, prop_id == '0')
 
-        if hasattr(ml_models[prop_id], 'treelite'):
-            batch = treelite.runtime.Batch.from_npy2d(np.array([d_input]))
-            try:
-                prediction = float(ml_models[prop_id].predict(batch))
-            except Exception as e:
-                return None, str(e)
-            if prop_id == '0': # account float votes of compiled trees instead of 0 vs. 1
-                prediction = int(round(prediction))
+    # production, the "w" regressor waits for the "0" classifier
+    tasks = {prop_id: submit(prop_id) for prop_id in prop_ids if prop_id != 'w'}
 
-        else:
-            try:
-                prediction = float(ml_models[prop_id].predict([d_input])[0])
-            except Exception as e:
-                return None, str(e)
+    for prop_id in prop_ids:
+
+        if prop_id == 'w':
+            tasks['w'] = submit('w')
+
+        if not tasks[prop_id]:
+            continue
 
-        #print("%s model yields %s" % (prop_id, prediction))
+        rows, future = tasks[prop_id]
+        predictions, error = future.result()
+        if error:
+            return None, error
 
         if prop_id == '0':
-            if prediction == 0:
-                result['w'] = {'value': 0, 'mae': 0, 'r2': 0}
+            gated[rows[predictions == 0]] = True
+            for n in rows[predictions == 0]:
+                results[n]['w'] = {'value': 0, 'mae': 0, 'r2': 0}
+            continue
 
-        else:
-            result[prop_id] = {
+        for n, prediction in zip(rows, predictions):
+            results[n][prop_id] = {
                 'value': round(
-                    prediction,
+                    float(prediction),
                     prop_models[prop_id]['rounding']
                 ),
                 'mae': round(
@@ -408,7 +979,106 @@ def get_prediction(descriptor, ml_models, prop_ids=False):
                 'r2': ml_models[prop_id].metadata['r2']
             }
 
-    return result, None
+    return results, None
+
+
+def reset_eval_pool():
+    # NB. the threads of the pool are not inherited by the forked workers
+    global eval_pool, eval_pool_lock, descriptor_pool
+    eval_pool, eval_pool_lock = None, threading.Lock()
+    descriptor_pool = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_eval_pool)
+
+
+def get_eval_pool():
+    """
+    The persistent thread pool shared by all the requests,
+    so that the EVAL_THREADS budget holds for them altogether;
+    created lazily, i.e. after the server workers are forked
+    """
+    global eval_pool
+
+    with eval_pool_lock:
+        if eval_pool is None:
+            eval_pool = ThreadPoolExecutor(max_workers=EVAL_THREADS, thread_name_prefix='mpds_ml_eval')
+
+    return eval_pool
+
+
+def init_descriptor_process():
+    # NB. the signal handlers of the server and the random state are inherited
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    random.seed()
+
+
+def start_descriptor_pool():
+    """
+    The persistent process pool for the descriptors of many structures;
+    NB. all its processes are forked at once on creation, which is safe
+    only before any threads are started, so it is never created lazily:
+    server.py starts it in a worker right after forking,
+    and without it the descriptors are obtained serially
+    """
+    global descriptor_pool
+
+    with eval_pool_lock:
+        if descriptor_pool is None:
+            descriptor_pool = ProcessPoolExecutor(
+                max_workers=DESCRIPTOR_PROCESSES,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=init_descriptor_process
+            )
+            descriptor_pool.submit(int).result()
+
+    return descriptor_pool
+
+
+def stop_descriptor_pool():
+    global descriptor_pool
+
+    with eval_pool_lock:
+        if descriptor_pool is not None:
+            descriptor_pool.shutdown(cancel_futures=True)
+            descriptor_pool = None
+
+
+def submit_evaluation(model, d_input, is_classifier=False):
+    """
+    Evaluate a model on the pool, since the tree predictions release the GIL,
+    or right away, if EVAL_THREADS is 1
+
+    Returns:
+        Future of predictions (numpy array) *or* None, None *or* error (str)
+    """
+    if EVAL_THREADS > 1:
+        return get_eval_pool().submit(evaluate_model, model, d_input, is_classifier)
+
+    future = Future()
+    future.set_result(evaluate_model(model, d_input, is_classifier))
+    return future
+
+
+def evaluate_model(model, d_input, is_classifier=False):
+
+    if hasattr(model, 'treelite'):
+        batch = treelite.runtime.Batch.from_npy2d(d_input)
+        try:
+            predictions = np.asarray(model.predict(batch), dtype=float).reshape(-1)
+        except Exception as e:
+            return None, str(e)
+        if is_classifier: # account float votes of compiled trees instead of 0 vs. 1
+            predictions = np.rint(predictions)
+
+    else:
+        try:
+            predictions = np.asarray(model.predict(d_input), dtype=float)
+        except Exception as e:
+            return None, str(e)
+
+    return predictions, None
 
 
 def get_regr(a=None, b=None):
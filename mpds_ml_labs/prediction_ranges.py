@@ -26,3 +26,8 @@ prediction_margins = {prop_id: (bounds[1] - bounds[0]) / 4 for prop_id, bounds i
 for prop_id in ['x', 'w', 't']:
     prediction_margins[prop_id] *= 10
 prediction_margins['i'] *= 100
+
+# the margins are tried progressively, as the fractions of prediction_margins,
+# until a level having enough knn results
+KNN_LEVELS = [0, 0.25, 0.5, 1]
+KNN_MIN_ROWS = 10
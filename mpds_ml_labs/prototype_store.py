@@ -0,0 +1,103 @@
+"""
+Local snapshot of the *els_comb* MPDS API results,
+i.e. the prototype structures per set of the chemical elements,
+see similar_els.get_similar_structs and prototype_store_builder.py
+"""
+import os
+import gzip
+import tempfile
+import threading
+
+import ujson as json
+
+
+__author__ = 'Evgeny Blokhin <eb@tilde.pro>'
+__copyright__ = 'Copyright (c) 2020, Evgeny Blokhin, Tilde Materials Informatics'
+__license__ = 'LGPL-2.1+'
+
+
+PROTOTYPE_FIELDS = ['entry', 'els_noneq', 'basis_noneq', 'occs_noneq', 'cell_abc', 'sg_n']
+
+
+def get_signature(els):
+    return '-'.join(sorted(set(els)))
+
+
+def open_snapshot(file_name, mode):
+    return gzip.open(file_name, mode + 't', encoding='utf-8') if file_name.endswith('.gz') else open(file_name, mode, encoding='utf-8')
+
+
+class PrototypeStore(object):
+    """
+    The rows of *els_comb* by the sorted elements signature,
+    kept serialized, so that each lookup gets its own copy
+    (NB. the rows are modified while materializing);
+    a signature without rows is also known, as having no prototypes.
+    The snapshot file has a line per signature: the signature, a tab and the rows in JSON
+    """
+    def __init__(self, file_name=None):
+        self.file_name = file_name
+        self.items = {}
+        self.lock = threading.Lock()
+        self.n_hits, self.n_misses = 0, 0
+
+        if file_name and os.path.exists(file_name):
+            with open_snapshot(file_name, 'r') as f:
+                for line in f:
+                    signature, rows = line.rstrip('\n').split('\t', 1)
+                    self.items[signature] = rows
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, els):
+        return get_signature(els) in self.items
+
+    def lookup(self, els_comb):
+        """
+        Returns:
+            Rows found (list)
+            Missing els (list), to be fetched
+        """
+        rows, missing = [], []
+        for els in els_comb:
+            payload = self.items.get(get_signature(els))
+            if payload is None:
+                missing.append(els)
+            else:
+                rows.extend(json.loads(payload))
+
+        with self.lock:
+            self.n_hits += len(els_comb) - len(missing)
+            self.n_misses += len(missing)
+
+        return rows, missing
+
+    def add(self, els_comb, rows):
+        """
+        Split the fetched rows by the requested els,
+        keeping only the prototype fields
+        """
+        found = {get_signature(els): [] for els in els_comb}
+        for row in rows:
+            signature = get_signature(row['els_noneq'])
+            if signature in found:
+                found[signature].append({field: row[field] for field in PROTOTYPE_FIELDS})
+
+        for signature, signature_rows in found.items():
+            self.items[signature] = json.dumps(signature_rows)
+
+    def save(self, file_name=None):
+        file_name = file_name or self.file_name
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)))
+        os.close(fd)
+
+        with open_snapshot(tmp_name if not file_name.endswith('.gz') else tmp_name + '.gz', 'w') as f:
+            for signature in sorted(self.items):
+                f.write(signature + '\t' + self.items[signature] + '\n')
+
+        if file_name.endswith('.gz'):
+            os.replace(tmp_name + '.gz', file_name)
+            os.unlink(tmp_name)
+        else:
+            os.replace(tmp_name, file_name)
@@ -0,0 +1,176 @@
+"""
+Cache of the prediction results, keyed by the canonical
+fingerprint of the structure and the version of the models
+"""
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import ujson as json
+
+
+__author__ = 'Evgeny Blokhin <eb@tilde.pro>'
+__copyright__ = 'Copyright (c) 2020, Evgeny Blokhin, Tilde Materials Informatics'
+__license__ = 'LGPL-2.1+'
+
+
+MAX_ALIASES = 100000 # raw inputs resolved to fingerprints
+DISK_SLACK = 0.1 # fraction of max_files evicted at once, so that the folder is rarely listed
+
+
+def get_fingerprint(ase_obj, precision=3):
+    """
+    Canonical fingerprint of a structure: the rounded cell parameters,
+    then the sorted sites, i.e. the species, the wrapped rounded
+    fractional coordinates and the occupancies, if any.
+    NB the ordered structures are expected refined,
+    i.e. spglib-standardized, see struct_utils.refine
+
+    Returns:
+        Fingerprint (str)
+    """
+    fmt = '%.' + str(precision) + 'f'
+    disorder = ase_obj.info.get('disordered', {})
+
+    positions = np.round(ase_obj.get_scaled_positions(wrap=True), precision) % 1 + 0.0
+    sites = []
+    for number, tag, position in zip(ase_obj.numbers, ase_obj.get_tags(), positions):
+        occupancies = sorted(
+            (el, fmt % occ) for el, occ in disorder.get(tag, {}).items()
+        ) if tag in disorder else []
+        sites.append((int(number), tuple(fmt % x for x in position), tuple(occupancies)))
+
+    canonical = json.dumps([
+        [fmt % x for x in ase_obj.cell.cellpar()],
+        sorted(sites)
+    ])
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def get_text_fingerprint(structure):
+    return hashlib.sha256(structure.encode('utf-8')).hexdigest()
+
+
+def get_models_version(ml_models):
+    """
+    Changes whenever the loaded models are replaced
+    """
+    return hashlib.sha256(json.dumps(sorted(
+        [prop_id, type(model).__name__, model.n_features_, model.metadata]
+        for prop_id, model in ml_models.items()
+    )).encode('utf-8')).hexdigest()[:16]
+
+
+class ResultCache(object):
+    """
+    In-memory LRU cache of the serialized results,
+    evicted by their total size, with an optional
+    on-disk tier (one file per key) surviving restarts,
+    bounded by max_files: the least recently used files are evicted
+    by their modification time, touched on reading.
+    Also keeps the aliases of the keys, e.g. the hashes of the raw inputs,
+    resolved to the fingerprints without parsing
+    """
+    def __init__(self, max_size, cache_dir=None, max_files=None):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.max_files = max_files
+        self.size = 0
+        self.items = OrderedDict()
+        self.aliases = OrderedDict()
+        self.lock = threading.Lock()
+        self.disk_lock = threading.Lock()
+        self.n_files = 0
+
+        if self.cache_dir and not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        if self.cache_dir:
+            self.n_files = len(os.listdir(self.cache_dir))
+
+    def get(self, key):
+        with self.lock:
+            key = self.aliases.get(key, key)
+            payload = self.items.get(key)
+            if payload is not None:
+                self.items.move_to_end(key)
+                return payload
+
+        if not self.cache_dir:
+            return None
+
+        try:
+            with open(os.path.join(self.cache_dir, key), 'r') as f:
+                payload = f.read()
+            os.utime(os.path.join(self.cache_dir, key))
+        except (IOError, OSError):
+            return None
+
+        self.store(key, payload)
+        return payload
+
+    def put(self, key, payload, alias=None):
+        self.store(key, payload, alias)
+
+        if not self.cache_dir:
+            return
+
+        fd, tmp_name = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            f.write(payload)
+        os.replace(tmp_name, os.path.join(self.cache_dir, key)) # NB atomic for the concurrent workers
+
+        with self.disk_lock:
+            self.n_files += 1
+            if self.max_files and self.n_files > self.max_files:
+                self.evict_files()
+
+    def evict_files(self):
+        """
+        Remove the oldest files down to max_files less DISK_SLACK;
+        NB. the other workers write to the same folder,
+        so the files are counted anew
+        """
+        files = []
+        for name in os.listdir(self.cache_dir):
+            try:
+                files.append((os.stat(os.path.join(self.cache_dir, name)).st_mtime, name))
+            except (IOError, OSError):
+                pass # NB. just evicted by another worker
+
+        files.sort()
+        n_evicted = max(0, len(files) - int(self.max_files * (1 - DISK_SLACK)))
+        for _, name in files[:n_evicted]:
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except (IOError, OSError):
+                pass
+
+        self.n_files = len(files) - n_evicted
+
+    def add_alias(self, alias, key):
+        with self.lock:
+            self.aliases[alias] = key
+            self.aliases.move_to_end(alias)
+            while len(self.aliases) > MAX_ALIASES:
+                self.aliases.popitem(last=False)
+
+    def store(self, key, payload, alias=None):
+        if alias:
+            self.add_alias(alias, key)
+
+        if len(payload) > self.max_size:
+            return
+
+        with self.lock:
+            if key in self.items:
+                self.size -= len(self.items.pop(key))
+
+            self.items[key] = payload
+            self.size += len(payload)
+
+            while self.size > self.max_size:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
@@ -0,0 +1,78 @@
+"""
+Vectorized scoring of the materialized structures
+against the requested property ranges, see similar_els.score_grade
+and similar_els.score_abs; the candidates are packed into
+an (N, n_props) array, and only the top ones are ordered
+"""
+import numpy as np
+
+from mpds_ml_labs.prediction import prop_models
+from mpds_ml_labs.prediction_ranges import prediction_ranges
+
+
+__author__ = 'Evgeny Blokhin <eb@tilde.pro>'
+__copyright__ = 'Copyright (c) 2020, Evgeny Blokhin, Tilde Materials Informatics'
+__license__ = 'LGPL-2.1+'
+
+
+SCORE_PROP_IDS = list(prop_models.keys())
+SCORE_WIDTHS = np.array([prediction_ranges[prop_id][1] - prediction_ranges[prop_id][0] for prop_id in SCORE_PROP_IDS])
+
+
+def pack_predictions(sequence):
+    """
+    Returns:
+        Predicted values of the candidates (float array of N x n_props)
+    """
+    return np.array([
+        [prediction[prop_id]['value'] for prop_id in SCORE_PROP_IDS]
+        for prediction in (item['prediction'] for item in sequence)
+    ], dtype=float).reshape(-1, len(SCORE_PROP_IDS))
+
+
+def unpack_ranges(prop_ranges_dict):
+    return (
+        np.array([prop_ranges_dict[prop_id + '_min'] for prop_id in SCORE_PROP_IDS], dtype=float),
+        np.array([prop_ranges_dict[prop_id + '_max'] for prop_id in SCORE_PROP_IDS], dtype=float)
+    )
+
+
+def get_grades(values, prop_ranges_dict, range_tols):
+    """
+    Number of the properties within the requested ranges, widened by the tolerances
+
+    Returns:
+        Grades (int array of N)
+    """
+    lower, upper = unpack_ranges(prop_ranges_dict)
+    tols = np.array([range_tols[prop_id] for prop_id in SCORE_PROP_IDS], dtype=float)
+
+    return ((lower - tols < values) & (values < upper + tols)).sum(axis=1)
+
+
+def get_distances(values, prop_ranges_dict):
+    """
+    Distance to the centers of the requested ranges,
+    i.e. the sum of the differences normalized by the prediction ranges
+
+    Returns:
+        Distances (float array of N)
+    """
+    lower, upper = unpack_ranges(prop_ranges_dict)
+
+    return (np.abs((lower + upper) / 2 - values) / SCORE_WIDTHS).sum(axis=1)
+
+
+def top_k(scores, k=1):
+    """
+    Indices of the k lowest scores in the ascending order;
+    the ties are kept in the original order, as by the stable sort,
+    although only the candidates up to the k-th score are sorted
+    """
+    if k >= len(scores):
+        return np.argsort(scores, kind='stable')
+
+    kth = scores[np.argpartition(scores, k - 1)[k - 1]]
+    candidates = np.flatnonzero(scores <= kth)
+
+    return candidates[np.argsort(scores[candidates], kind='stable')][:k]
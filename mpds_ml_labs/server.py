@@ -0,0 +1,158 @@
+"""
+Preforking production server: the models are loaded
+and warmed up once in the master process, then
+the workers are forked, sharing them copy-on-write.
+The workers are recycled after max_requests,
+or all of them one by one on SIGHUP; SIGTERM or SIGINT stop the server.
+
+Usage: python -m mpds_ml_labs.server [host:]port
+"""
+import os
+import sys
+import time
+import signal
+import socket
+import threading
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+from flask import Flask
+
+import mpds_ml_labs.app as labs
+import mpds_ml_labs.prediction as prediction
+from mpds_ml_labs.common import EVAL_THREADS, DESCRIPTOR_PROCESSES, SERVER_WORKERS, SERVER_MAX_REQUESTS
+from mpds_ml_labs.prediction import start_descriptor_pool, stop_descriptor_pool
+
+
+__author__ = 'Evgeny Blokhin <eb@tilde.pro>'
+__copyright__ = 'Copyright (c) 2020, Evgeny Blokhin, Tilde Materials Informatics'
+__license__ = 'LGPL-2.1+'
+
+
+DEFAULT_ADDRESS = ('127.0.0.1', 5000)
+LISTEN_BACKLOG = 128
+
+
+class WorkerServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = False # NB. the requests in flight are finished on shutdown
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def run_worker(sock, wsgi_app, max_requests):
+    """
+    Serve the inherited listening socket until SIGTERM
+    or until max_requests are served
+    """
+    if DESCRIPTOR_PROCESSES > 1:
+        start_descriptor_pool() # NB. still no threads here
+
+    httpd = WorkerServer(sock.getsockname(), QuietHandler, bind_and_activate=False)
+    httpd.socket = sock
+    httpd.server_name, httpd.server_port = socket.getfqdn(sock.getsockname()[0]), sock.getsockname()[1]
+    httpd.setup_environ()
+
+    n_served, lock = [0], threading.Lock()
+
+    def stop(*args):
+        # NB. shutdown waits for serve_forever, hence another thread
+        threading.Thread(target=httpd.shutdown).start()
+
+    def counting_app(environ, start_response):
+        with lock:
+            n_served[0] += 1
+            if n_served[0] == max_requests:
+                stop()
+        return wsgi_app(environ, start_response)
+
+    httpd.set_app(counting_app if max_requests else wsgi_app)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # NB. handled by the master
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+    httpd.serve_forever()
+    httpd.server_close()
+    stop_descriptor_pool()
+
+
+def serve(wsgi_app, address, n_workers, max_requests=0):
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(LISTEN_BACKLOG)
+
+    workers, to_recycle, state = set(), [], {'stopping': False}
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(sock, wsgi_app, max_requests)
+            finally:
+                os._exit(0)
+        workers.add(pid)
+
+    def stop(*args):
+        state['stopping'] = True
+        for pid in list(workers):
+            os.kill(pid, signal.SIGTERM)
+
+    def recycle(*args):
+        to_recycle[:] = sorted(workers)
+        if to_recycle:
+            os.kill(to_recycle.pop(), signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, recycle)
+
+    for _ in range(n_workers):
+        spawn()
+    print("Serving http://%s:%s with %s workers" % (address[0], address[1], n_workers))
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+
+        workers.discard(pid)
+        if state['stopping']:
+            continue
+
+        spawn()
+
+        # rolling restart, one worker at a time
+        while to_recycle:
+            pid = to_recycle.pop()
+            if pid in workers:
+                os.kill(pid, signal.SIGTERM)
+                break
+
+    sock.close()
+
+
+if __name__ == '__main__':
+
+    address = DEFAULT_ADDRESS
+    if sys.argv[1:]:
+        host, _, port = sys.argv[1].rpartition(':')
+        address = (host or DEFAULT_ADDRESS[0], int(port))
+
+    # NB. the evaluation threads budget is for all the workers
+    prediction.EVAL_THREADS = max(1, EVAL_THREADS // SERVER_WORKERS)
+
+    start_time = time.time()
+    labs.warmup()
+    print("Warmup done in %1.2f sc" % (time.time() - start_time))
+
+    app = Flask(__name__)
+    app.debug = False
+    app.register_blueprint(labs.app_labs)
+
+    serve(app.wsgi_app, address, SERVER_WORKERS, SERVER_MAX_REQUESTS)
@@ -1,16 +1,23 @@
 
-import logging
+import os
 import time
+import random
+import logging
+import threading
 #from pprint import pprint
 from urllib.parse import urlencode
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
 import ujson as json
 import httplib2
 
-from mpds_ml_labs.prediction import prop_models, periodic_elements, periodic_numbers, ase_to_prediction
+from mpds_ml_labs.prediction import prop_models, periodic_elements, periodic_numbers, ase_to_predictions
 from mpds_ml_labs.prediction_ranges import prediction_ranges, RANGE_TOLERANCE
 from mpds_ml_labs.struct_utils import json_to_ase
-from mpds_ml_labs.common import API_KEY, ELS_ENDPOINT
+from mpds_ml_labs.common import API_KEY, ELS_ENDPOINT, PROTOTYPES_FILE, HTTP_CONCURRENCY, HTTP_DEADLINE, DESIGN_THREADS, pooled_http
+from mpds_ml_labs.prototype_store import PrototypeStore, get_signature
+from mpds_ml_labs.scoring import pack_predictions, get_grades, get_distances, top_k
 
 
 __author__ = 'Evgeny Blokhin <eb@tilde.pro>'
@@ -18,12 +25,15 @@ __copyright__ = 'Copyright (c) 2018, Evgeny Blokhin, Tilde Materials Informatics
 __license__ = 'LGPL-2.1+'
 
 
-network = httplib2.Http()
+ELS_BACKOFF = 0.5 # sc before the first retry, then doubled
+ELS_MAX_BACKOFF = 8 # sc
+ELS_BATCH = 25 # combinations per request of a merged lookup, see MaterializeMemo
+NO_RESULTS_ERROR = "No results (cannot compile crystal structure)"
+TIMEOUT_ERROR = "No results (time budget exceeded)"
 
-normalized_f = {
-    prop_id: lambda x: (x - bound[0]) / (bound[1] - bound[0])
-    for prop_id, bound in prediction_ranges.items()
-}
+lookup_pool, lookup_pool_lock = None, threading.Lock() # see prefetch_similar_structs
+materialize_pool = None # see materialize_in_order
+prototype_store = PrototypeStore(PROTOTYPES_FILE) if PROTOTYPES_FILE else None # NB. only the misses are fetched
 
 
 def get_similar_els(els):
@@ -77,29 +87,77 @@ def get_similar_els(els):
     return result, None
 
 
-def get_similar_structs(els_comb):
+def get_similar_structs(els_comb, deadline=None):
+    """
+    Look up the MPDS S-entries, composed by
+    the given chemical elements, in the prototype store,
+    fetching only the missing ones, if the endpoint is defined
+    """
+    if prototype_store is None:
+        return fetch_similar_structs(els_comb, deadline)
+
+    rows, missing = prototype_store.lookup(els_comb)
+    if not missing or not ELS_ENDPOINT:
+        return rows, None
+
+    fetched, error = fetch_similar_structs(missing, deadline)
+    if error:
+        return None, error
+
+    prototype_store.add(missing, fetched)
+    return rows + fetched, None
+
+
+def fetch_similar_structs(els_comb, deadline=None):
     """
     Employ an *els_comb* MPDS API method,
     returning the MPDS S-entries,
-    composed by the given chemical elements
+    composed by the given chemical elements;
+    the rate-limited and failed requests are retried
+    with the capped exponential backoff and the jitter,
+    until the deadline (timestamp, HTTP_DEADLINE from now by default)
     """
     if not ELS_ENDPOINT:
         return None, 'No similarity search endpoint defined'
 
-    response, content = network.request(
-        uri=ELS_ENDPOINT + '?' + urlencode({
-            'input': json.dumps(els_comb)
-        }),
-        method='GET',
-        headers={'Key': API_KEY}
-    )
+    if deadline is None:
+        deadline = time.time() + HTTP_DEADLINE
 
-    if response.status == 429:
-        time.sleep(2)
-        return get_similar_structs(els_comb)
+    uri = ELS_ENDPOINT + '?' + urlencode({
+        'input': json.dumps(els_comb)
+    })
 
-    elif response.status != 200:
-        return None, 'While similarity search an HTTP error %s occured' % response.status
+    attempt = 0
+    while True:
+        try:
+            with pooled_http(uri, deadline - time.time()) as network:
+                response, content = network.request(
+                    uri=uri,
+                    method='GET',
+                    headers={'Key': API_KEY}
+                )
+            status = response.status
+
+        except (httplib2.HttpLib2Error, OSError):
+            response, status = {}, None
+
+        if status == 200:
+            break
+
+        elif status is not None and status != 429 and status < 500:
+            return None, 'While similarity search an HTTP error %s occured' % status
+
+        delay = random.uniform(0, min(ELS_MAX_BACKOFF, ELS_BACKOFF * 2**attempt))
+        try: delay = max(delay, float(response.get('retry-after', 0)))
+        except ValueError: pass
+
+        if time.time() + delay >= deadline:
+            return None, 'Similarity search is not available, %s' % (
+                'HTTP error %s occured' % status if status else 'no response'
+            )
+
+        time.sleep(delay)
+        attempt += 1
 
     try:
         content = json.loads(content)
@@ -109,6 +167,34 @@ def get_similar_structs(els_comb):
     return content, None
 
 
+def reset_lookup_pool():
+    # NB. the threads of the pool are not inherited by the forked workers
+    global lookup_pool, lookup_pool_lock, materialize_pool
+    lookup_pool, lookup_pool_lock = None, threading.Lock()
+    materialize_pool = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_lookup_pool)
+
+
+def prefetch_similar_structs(els_combs, deadline=None):
+    """
+    Start several get_similar_structs at once,
+    limited by HTTP_CONCURRENCY anyway;
+    the lookups not needed are to be cancelled
+
+    Returns:
+        Futures of get_similar_structs results (list)
+    """
+    global lookup_pool
+
+    with lookup_pool_lock:
+        if lookup_pool is None:
+            lookup_pool = ThreadPoolExecutor(max_workers=HTTP_CONCURRENCY, thread_name_prefix='mpds_ml_els')
+
+    return [lookup_pool.submit(get_similar_structs, els_comb, deadline) for els_comb in els_combs]
+
+
 def get_group(z):
     if z == 1:
         return 1
@@ -165,12 +251,106 @@ def compact_by_disorder(given_els):
     return compacted_els, new_occs
 
 
-def materialize(given_els, active_ml_models):
+class MaterializeMemo(object):
+    """
+    Memo of materialize: the prototype rows by the els signature (see PrototypeStore),
+    the predicted structures by their prototype and els, and the results by the given els.
+    Either for a single request, or shared by the requests, if max_items is given
+    (then per table, the least recently used items are dropped;
+    the prototype rows are dropped in the order of addition)
+    """
+    def __init__(self, max_items=None):
+        self.max_items = max_items
+        self.prototypes = PrototypeStore()
+        self.structures = OrderedDict()
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        self.n_hits, self.n_misses = 0, 0 # structures
+
+    def get(self, table, key):
+        with self.lock:
+            value = table.get(key)
+            if value is not None:
+                table.move_to_end(key)
+            return value
+
+    def put(self, table, key, value):
+        with self.lock:
+            table[key] = value
+            table.move_to_end(key)
+            while self.max_items and len(table) > self.max_items:
+                table.popitem(last=False)
+
+    def lookup(self, els_combs, deadline=None):
+        """
+        Look up the prototype rows for all the els_combs at once,
+        e.g. for all the children of a frontier level;
+        only the els not seen before are looked up,
+        by the concurrent batches of ELS_BATCH
+
+        Returns:
+            Rows per els_comb (list of lists) *or* None
+            None *or* error (str)
+        """
+        missing = {}
+        for els_comb in els_combs:
+            for els in els_comb:
+                if els not in self.prototypes:
+                    missing.setdefault(get_signature(els), els)
+        missing = list(missing.values())
+
+        batches = [missing[n:n + ELS_BATCH] for n in range(0, len(missing), ELS_BATCH)]
+        lookups = prefetch_similar_structs(batches, deadline)
+        try:
+            fetched = []
+            for lookup in lookups:
+                rows, error = lookup.result()
+                if error:
+                    return None, error
+                fetched += rows
+        finally:
+            for lookup in lookups:
+                lookup.cancel()
+
+        with self.lock:
+            self.prototypes.add(missing, fetched)
+            result = [self.prototypes.lookup(els_comb)[0] for els_comb in els_combs]
+
+            while self.max_items and len(self.prototypes) > self.max_items:
+                del self.prototypes.items[next(iter(self.prototypes.items))]
+
+        return result, None
+
+
+def materialize(given_els, active_ml_models, memo=None, deadline=None):
     """
     Given a list of the chemical elements,
     get scored crystal structures, having either
-    exactly these elements or chemically similar elements
+    exactly these elements or chemically similar elements;
+    the memo (MaterializeMemo) is to be shared by the calls of a request,
+    the deadline (timestamp) limits the lookups
     """
+    if memo is None:
+        memo = MaterializeMemo()
+
+    key = tuple(given_els)
+    result = memo.get(memo.results, key)
+    if result is None:
+        result = materialize_uncached(given_els, active_ml_models, memo, deadline)
+
+        if result[0] or result[1] == NO_RESULTS_ERROR:
+            memo.put(memo.results, key, result)
+
+    sequence, error = result
+    if error:
+        return None, error
+
+    # NB. the items get graded and replaced by the callers
+    return [dict(item) for item in sequence], None
+
+
+def materialize_uncached(given_els, active_ml_models, memo, deadline=None):
+
     compacted_els, new_occs = compact_by_disorder(given_els)
 
     els_comb, error = get_similar_els(compacted_els)
@@ -179,37 +359,100 @@ def materialize(given_els, active_ml_models):
 
     els_comb.append(compacted_els)
 
-    sequence, error = massage_by_similarity(els_comb, compacted_els, new_occs, active_ml_models)
+    sequence, error = massage_by_similarity(els_comb, compacted_els, new_occs, active_ml_models, memo, deadline)
     if error:
         return None, error
 
     if not sequence:
+        grand_child_els_combs, child_error = [], None
         for child in els_comb:
+            grand_child_els_comb, child_error = get_similar_els(child)
+            if child_error:
+                break
+            grand_child_els_combs.append(grand_child_els_comb)
 
-            grand_child_els_comb, error = get_similar_els(child)
-            if error:
-                return None, error
+        # NB. the whole frontier is looked up at once, but the first result in order is taken
+        _, error = memo.lookup(grand_child_els_combs, deadline)
+        if error:
+            return None, error
 
-            sequence, error = massage_by_similarity(grand_child_els_comb, compacted_els, new_occs, active_ml_models)
+        for grand_child_els_comb in grand_child_els_combs:
+
+            sequence, error = massage_by_similarity(grand_child_els_comb, compacted_els, new_occs, active_ml_models, memo, deadline)
             if error:
                 return None, error
 
             if sequence:
                 break
+        else:
+            if child_error:
+                return None, child_error
 
     if not sequence:
-        return None, "No results (cannot compile crystal structure)"
+        return None, NO_RESULTS_ERROR
 
     return sequence, None
 
 
-def massage_by_similarity(input_els_comb, ref_els, ref_occs, active_ml_models):
+def materialize_in_order(els_samples, active_ml_models, memo=None, deadline=None):
+    """
+    Materialize the els samples concurrently, up to DESIGN_THREADS at once
+    on a pool shared by the requests, yielding the results in the order of samples,
+    as if materialized one by one; the samples not started yet are cancelled,
+    once the iteration is stopped. After the deadline (timestamp),
+    the TIMEOUT_ERROR is yielded as the last result
+
+    Yields:
+        Scored structures (list) *or* None
+        None *or* error (str)
+    """
+    global materialize_pool
+
+    with lookup_pool_lock:
+        if materialize_pool is None:
+            materialize_pool = ThreadPoolExecutor(max_workers=DESIGN_THREADS, thread_name_prefix='mpds_ml_design')
+
+    if memo is None:
+        memo = MaterializeMemo()
+
+    els_samples, pending = iter(els_samples), deque()
+    try:
+        while True:
+            for els in els_samples:
+                pending.append(materialize_pool.submit(materialize, els, active_ml_models, memo, deadline))
+                if len(pending) == DESIGN_THREADS:
+                    break
 
-    rows, error = get_similar_structs(input_els_comb)
+            if not pending:
+                return
+
+            try:
+                result = pending[0].result(timeout=None if deadline is None else max(0, deadline - time.time()))
+            except TimeoutError:
+                yield None, TIMEOUT_ERROR
+                return
+
+            pending.popleft()
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def massage_by_similarity(input_els_comb, ref_els, ref_occs, active_ml_models, memo=None, deadline=None):
+    """
+    Optionally, the prototype rows and the predicted structures
+    are taken from the memo (MaterializeMemo), and added there
+    """
+    if memo:
+        rows, error = memo.lookup([input_els_comb], deadline)
+        rows = rows and rows[0]
+    else:
+        rows, error = get_similar_structs(input_els_comb, deadline)
     if error:
         return None, error
 
-    sequence = []
+    sequence, ase_objs, keys = [], [], []
 
     for row in rows:
         els_were = list(set(ref_els) - set(row['els_noneq']))
@@ -238,55 +481,68 @@ def massage_by_similarity(input_els_comb, ref_els, ref_occs, active_ml_models):
                 row['occs_noneq'][n] /= (len(ref_occs[new_el]) + 1)
                 row['occs_noneq'].append(row['occs_noneq'][n])
 
+        key = (row['entry'], tuple(new_els))
+        item = memo.get(memo.structures, key) if memo else None
+        if item:
+            sequence.append(item)
+            continue
+
         ase_obj, error = json_to_ase([row['occs_noneq'], row['cell_abc'], row['sg_n'], row['basis_noneq'], new_els])
         if error:
-            return None, error
+            break
 
-        prediction, error = ase_to_prediction(ase_obj, active_ml_models)
-        if error:
-            return None, error
+        sequence.append(None) # NB. to be predicted below, in order
+        ase_objs.append(ase_obj)
+        keys.append(key)
+
+    # NB. the structures preceding a broken one are predicted anyway, to report their errors first
+    predictions, prediction_error = ase_to_predictions(ase_objs, active_ml_models)
+    if prediction_error:
+        return None, prediction_error
+    if error:
+        return None, error
 
-        sequence.append({"structure": ase_obj, "prediction": prediction})
+    if memo:
+        with memo.lock:
+            memo.n_hits += len(sequence) - len(ase_objs)
+            memo.n_misses += len(ase_objs)
+
+    predicted = iter(zip(keys, ase_objs, predictions))
+    for n in range(len(sequence)):
+        if sequence[n] is None:
+            key, ase_obj, prediction = next(predicted)
+            sequence[n] = {"structure": ase_obj, "prediction": prediction}
+            if memo:
+                memo.put(memo.structures, key, sequence[n])
 
     return sequence, None
 
 
 def score_abs(sequence, prop_ranges_dict):
-
+    """
+    The candidate nearest to the centers of the requested ranges,
+    see scoring.get_distances; the first one of the equally near
+    """
     if len(sequence) == 1:
         return sequence[0]
 
-    ideal_predictions = {prop_id: (prop_ranges_dict[prop_id + '_min'] + prop_ranges_dict[prop_id + '_max']) / 2 for prop_id in prop_models}
-
-    sequence.sort(key=lambda x: sum([
-        normalized_f[prop_id]( abs(ideal_predictions[prop_id] - x["prediction"][prop_id]["value"]) ) for prop_id in prop_models
-    ]))
-
-    #print("*"*50)
-    #pprint(ideal_predictions)
-    #print("vs.")
-    #pprint(sequence)
-    #print("*"*50)
-
-    return sequence[0]
+    distances = get_distances(pack_predictions(sequence), prop_ranges_dict)
+    return sequence[top_k(distances)[0]]
 
 
 def score_grade(sequence, prop_ranges_dict, range_tols):
-
+    """
+    The candidate having the most properties within the requested ranges,
+    see scoring.get_grades; the first one of the equally graded.
+    All the candidates get their *grade*
+    """
     assert range_tols
 
-    for n in range(len(sequence)):
-
-        assert sequence[n]['prediction']
-        sequence[n]["grade"] = 0
-
-        for prop_id in prop_models:
-
-            if prop_ranges_dict[prop_id + '_min'] - range_tols[prop_id] < sequence[n]['prediction'][prop_id]['value'] < prop_ranges_dict[prop_id + '_max'] + range_tols[prop_id]:
-                sequence[n]["grade"] += 1
+    grades = get_grades(pack_predictions(sequence), prop_ranges_dict, range_tols)
+    for item, grade in zip(sequence, grades.tolist()):
+        item["grade"] = grade
 
-    sequence.sort(key=lambda x: x["grade"], reverse=True)
-    return sequence[0]
+    return sequence[top_k(-grades)[0]]
 
 
 if __name__ == "__main__":
@@ -339,7 +595,7 @@ if __name__ == "__main__":
         't_min': -10, 't_max': -9,
         'i_min': 1200, 'i_max': 1400,
         'o_min': -10, 'o_max': 0
-    }))
+    }, {prop_id: 0 for prop_id in prop_models}))
 
     print(compact_by_disorder(['Si', 'Cr', 'Mo', 'W', 'O']))
     print(compact_by_disorder(['Li', 'O', 'Mn', 'B', 'Fr', 'Re', 'Tc', 'Ga', 'Ra', 'Al']))
@@ -369,6 +625,37 @@ if __name__ == "__main__":
             prop_id: {'value': random.uniform(*bounds)} for prop_id, bounds in prediction_ranges.items()
         }}
 
-    results = [gen_mockup_result() for _ in range(500)]
-    #print(score_abs(results, sample))
-    print(score_grade(results, sample, range_tols))
+    # benchmark against the loops over the candidates and the full sort
+    import time
+    from mpds_ml_labs.scoring import SCORE_PROP_IDS, SCORE_WIDTHS
+
+    ideal = {prop_id: (sample[prop_id + '_min'] + sample[prop_id + '_max']) / 2 for prop_id in SCORE_PROP_IDS}
+    widths = dict(zip(SCORE_PROP_IDS, SCORE_WIDTHS))
+
+    for n_candidates in [500, 10000, 100000]:
+        results = [gen_mockup_result() for _ in range(n_candidates)]
+
+        start_time = time.time()
+        values = pack_predictions(results)
+        packed = time.time() - start_time
+
+        best_graded = results[top_k(-get_grades(values, sample, range_tols))[0]]
+        best_abs = results[top_k(get_distances(values, sample))[0]]
+        scored = time.time() - start_time - packed
+
+        start_time = time.time()
+        grades = [sum(
+            sample[prop_id + '_min'] - range_tols[prop_id] < x['prediction'][prop_id]['value'] < sample[prop_id + '_max'] + range_tols[prop_id]
+            for prop_id in SCORE_PROP_IDS
+        ) for x in results]
+        sorted_graded = [x for _, x in sorted(zip(grades, results), key=lambda pair: pair[0], reverse=True)]
+        sorted_abs = sorted(results, key=lambda x: sum(
+            abs(ideal[prop_id] - x['prediction'][prop_id]['value']) / widths[prop_id] for prop_id in SCORE_PROP_IDS
+        ))
+        looped = time.time() - start_time
+
+        assert best_graded is sorted_graded[0] and best_abs is sorted_abs[0]
+        assert score_grade(results, sample, range_tols) is best_graded and score_abs(results, sample) is best_abs
+        print("%s candidates: packed in %1.3f sc, scored in %1.3f sc; looped and sorted in %1.3f sc" % (
+            n_candidates, packed, scored, looped
+        ))
@@ -240,24 +240,20 @@ def sgn_to_crsystem(number):
 MAX_ATOMS = 1000
 SITE_SUM_OCCS_TOL = 0.99
 
-def order_disordered(ase_obj):
+def get_disorder_supercell(ase_obj, max_atoms=MAX_ATOMS):
     """
-    This is a toy algo to get rid of the structural disorder;
-    just one random possible ordered structure is returned
-    (out of may be billions). No attempt to embrace all permutations is made.
-    For that one needs to consider the special-purpose software (e.g.
-    https://doi.org/10.1186/s13321-016-0129-3 etc.).
+    Complete the partial occupancies with the vacancies (X)
+    and find the supercell, big enough to distribute the
+    disordered species over it
 
     Args:
         ase_obj: (object) ASE structure; must have *info* dict *disordered* and *Atom* tags
-            *disordered* dict format: {'disordered': {at_index: {element: occupancy, ...}, ...}
+        max_atoms: (int) supercell size limit, None if the supercell is not to be built
 
     Returns:
-        ASE structure (object) *or* None
+        Supercell matrix (list) *or* None
+        Species to distribute (dict): {at_index: [element, ...], ...} *or* None
         None *or* error (str)
-
-    TODO?
-    Rewrite space group info accordingly
     """
     for index in ase_obj.info['disordered']:
         if sum(ase_obj.info['disordered'][index].values()) < SITE_SUM_OCCS_TOL:
@@ -272,22 +268,52 @@ def order_disordered(ase_obj):
         )
     )
     if min_occ == 0:
-        return None, 'Zero occupancy is encountered'
+        return None, None, 'Zero occupancy is encountered'
 
     needed_det = math.ceil(1. / min_occ)
-    if needed_det * len(ase_obj) > MAX_ATOMS:
-        return None, 'Resulting crystal cell size is too big'
+    if max_atoms and needed_det * len(ase_obj) > max_atoms:
+        return None, None, 'Resulting crystal cell size is too big'
 
     diag = needed_det ** (1. / 3)
     supercell_matrix = [int(x) for x in (round(diag), math.ceil(diag), math.ceil(diag))]
     actual_det = reduce(lambda x, y: x * y, supercell_matrix)
 
-    occ_data = {}
+    species = {}
     for index, occs in ase_obj.info['disordered'].items():
-        disorder = []
+        species[index] = []
         for el, occ in occs.items():
-            disorder += [el] * int(round(occ * actual_det))
-        random.shuffle(disorder)
+            species[index] += [el] * int(round(occ * actual_det))
+
+    return supercell_matrix, species, None
+
+
+def order_disordered(ase_obj, rng=random):
+    """
+    This is a toy algo to get rid of the structural disorder;
+    just one random possible ordered structure is returned
+    (out of may be billions). No attempt to embrace all permutations is made.
+    For that one needs to consider the special-purpose software (e.g.
+    https://doi.org/10.1186/s13321-016-0129-3 etc.).
+
+    Args:
+        ase_obj: (object) ASE structure; must have *info* dict *disordered* and *Atom* tags
+            *disordered* dict format: {'disordered': {at_index: {element: occupancy, ...}, ...}
+        rng: (object) random generator, to obtain a reproducible ordering
+
+    Returns:
+        ASE structure (object) *or* None
+        None *or* error (str)
+
+    TODO?
+    Rewrite space group info accordingly
+    """
+    supercell_matrix, species, error = get_disorder_supercell(ase_obj)
+    if error:
+        return None, error
+
+    occ_data = {}
+    for index, disorder in species.items():
+        rng.shuffle(disorder)
         occ_data[index] = itertools.cycle(disorder)
 
     order_obj = ase_obj.copy()
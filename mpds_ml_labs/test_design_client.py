@@ -3,8 +3,8 @@ import time
 import httplib2
 import ujson as json
 
-from cif_utils import cif_to_ase
-from common import make_request
+from mpds_ml_labs.cif_utils import cif_to_ase
+from mpds_ml_labs.common import make_request
 
 
 remote = httplib2.Http()
@@ -2,13 +2,13 @@
 import random
 import time
 
-from struct_utils import order_disordered
-from knn_sample import knn_sample
-from similar_els import materialize, score_grade, score_abs
-from common import connect_database, ML_MODELS
-from cif_utils import ase_to_eq_cif, cif_to_ase
-from prediction import prop_models, load_ml_models
-from prediction_ranges import prediction_ranges, RANGE_TOLERANCE
+from mpds_ml_labs.struct_utils import order_disordered
+from mpds_ml_labs.knn_sample import knn_sample
+from mpds_ml_labs.similar_els import MaterializeMemo, materialize, score_grade, score_abs
+from mpds_ml_labs.common import connect_database, ML_MODELS
+from mpds_ml_labs.cif_utils import ase_to_eq_cif, cif_to_ase
+from mpds_ml_labs.prediction import prop_models, load_ml_models
+from mpds_ml_labs.prediction_ranges import prediction_ranges, RANGE_TOLERANCE
 
 
 result, error = None, "No results (outside of prediction capabilities)"
@@ -34,18 +34,19 @@ active_ml_models = load_ml_models(ML_MODELS, debug=False)
 start_time = time.time()
 
 cursor, connection = connect_database()
-els_samples = knn_sample(cursor, sample)
+els_samples, knn_level = knn_sample(cursor, sample)
 connection.close()
+print("KNN level: %s" % knn_level)
 
-output = []
+output, memo = [], MaterializeMemo()
 MAX_DESIGN_MATCH = True
 
 if MAX_DESIGN_MATCH:
     while len(els_samples):
 
-        els_sample = els_samples.pop()
+        els_sample, _ = els_samples.pop()
 
-        sequence, error = materialize(els_sample, active_ml_models)
+        sequence, error = materialize(els_sample, active_ml_models, memo)
         if error:
             break
         if not sequence:
@@ -58,12 +59,12 @@ if MAX_DESIGN_MATCH:
         if len(output) > 1:
             break
 else:
-    for n_attempt, els_sample in enumerate(els_samples):
+    for n_attempt, (els_sample, _) in enumerate(els_samples):
 
         if n_attempt > 3:
             break
 
-        sequence, error = materialize(els_sample, active_ml_models)
+        sequence, error = materialize(els_sample, active_ml_models, memo)
         if error:
             break
         if not sequence:
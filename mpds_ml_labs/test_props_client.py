@@ -7,10 +7,10 @@ import httplib2
 import numpy as np
 from mpds_client import MPDSDataRetrieval, APIError
 
-from prediction import prop_models
-from struct_utils import detect_format, poscar_to_ase, refine, get_formula, sgn_to_crsystem
-from cif_utils import cif_to_ase
-from common import API_KEY, API_ENDPOINT, make_request
+from mpds_ml_labs.prediction import prop_models
+from mpds_ml_labs.struct_utils import detect_format, poscar_to_ase, refine, get_formula, sgn_to_crsystem
+from mpds_ml_labs.cif_utils import cif_to_ase
+from mpds_ml_labs.common import API_KEY, API_ENDPOINT, make_request
 
 
 remote = httplib2.Http()
@@ -2,10 +2,10 @@
 import os, sys
 import time
 
-from struct_utils import detect_format, poscar_to_ase, refine
-from cif_utils import cif_to_ase
-from prediction import ase_to_prediction, load_ml_models, load_comp_models, prop_models
-from common import ML_MODELS, COMP_MODELS, DATA_PATH
+from mpds_ml_labs.struct_utils import detect_format, poscar_to_ase, refine
+from mpds_ml_labs.cif_utils import cif_to_ase
+from mpds_ml_labs.prediction import ase_to_prediction, load_ml_models, load_comp_models, prop_models
+from mpds_ml_labs.common import ML_MODELS, COMP_MODELS, DATA_PATH
 
 
 models, structures = [], []
@@ -0,0 +1,84 @@
+"""
+Build or refresh the local snapshot of the *els_comb* MPDS API results
+(see mpds_ml_labs/prototype_store.py), set as *prototypes* in the settings.
+All the element combinations, which might be looked up by materialize
+for the els of the ml_knn table, are fetched: either for the in-process table file (*.knn),
+or for the Postgres table of the settings (*db*).
+Only the combinations missing in the snapshot are fetched, unless --refresh is given;
+the snapshot is saved periodically, so an interrupted build is resumed
+"""
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mpds_ml_labs.knn_engine import load_knn_table, decode_els, encode_els
+from mpds_ml_labs.similar_els import compact_by_disorder, get_similar_els, fetch_similar_structs
+from mpds_ml_labs.prototype_store import PrototypeStore, get_signature
+from mpds_ml_labs.common import KNN_TABLE, HTTP_CONCURRENCY, connect_database
+
+
+FETCH_BATCH = 25 # combinations per request
+SAVE_EVERY = 100 # requests
+
+
+def get_knn_els(source):
+    if source == 'db':
+        cursor, connection = connect_database()
+        cursor.execute("SELECT DISTINCT els FROM %s" % KNN_TABLE)
+        decks = encode_els([row[0] for row in cursor.fetchall()])
+        connection.close()
+    else:
+        decks = load_knn_table(source).arrays['els']
+
+    return [els for els, _ in decode_els(decks, ordered=True)]
+
+
+def get_lookup_combs(els):
+    """
+    The combinations, which materialize might look up for the els
+    """
+    compacted_els, _ = compact_by_disorder(els)
+    els_comb, error = get_similar_els(compacted_els)
+    if error:
+        return []
+
+    combs = els_comb + [compacted_els]
+    for child in els_comb:
+        grand_child_els_comb, error = get_similar_els(child)
+        if error:
+            break
+        combs += grand_child_els_comb
+    return combs
+
+
+assert len(sys.argv) > 2, "Usage: prototype_store_builder.py snapshot.tsv[.gz] ml_knn.knn|db [--refresh]"
+
+start_time = time.time()
+store = PrototypeStore(sys.argv[1])
+print("Snapshot has %s combinations" % len(store))
+
+combs = {}
+for els in get_knn_els(sys.argv[2]):
+    for comb in get_lookup_combs(els):
+        combs.setdefault(get_signature(comb), comb)
+
+to_fetch = [comb for signature, comb in sorted(combs.items()) if '--refresh' in sys.argv or signature not in store.items]
+print("Combinations for ml_knn: %s, to fetch: %s" % (len(combs), len(to_fetch)))
+
+batches = [to_fetch[n:n + FETCH_BATCH] for n in range(0, len(to_fetch), FETCH_BATCH)]
+n_failed = 0
+
+with ThreadPoolExecutor(max_workers=HTTP_CONCURRENCY) as pool:
+    for n, (batch, (rows, error)) in enumerate(zip(batches, pool.map(fetch_similar_structs, batches)), start=1):
+        if error:
+            print(error)
+            n_failed += 1
+            continue
+
+        store.add(batch, rows)
+        if n % SAVE_EVERY == 0:
+            store.save()
+            print("Fetched %s of %s batches" % (n, len(batches)))
+
+store.save()
+print("Done with %s combinations, %s batches failed, in %1.2f sc" % (len(store), n_failed, time.time() - start_time))